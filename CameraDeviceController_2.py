@@ -11,7 +11,6 @@ import PyTango.futures as ptf
 import numpy as np
 import logging
 import DeviceController as dc
-import Queue
 
 root = logging.getLogger("CameraDeviceController")
 while len(root.handlers):
@@ -58,8 +57,6 @@ class CameraDeviceController(object):
         self.state_thread = threading.Thread()
         threading.Thread.__init__(self.state_thread, target=self.statehandler_dispatcher)
 
-        self.command_queue = Queue.Queue(100)
-
         self.statehandler_dict = {pt.DevState.ON: self.on_handler,
                                   pt.DevState.STANDBY: self.on_handler,
                                   pt.DevState.RUNNING: self.on_handler,
@@ -135,15 +132,18 @@ class CameraDeviceController(object):
             stop_delay_cmd.add_condition(stop_cmd)
             stop_delay_cmd.start()
             prev_cmd = stop_cmd
-            for param in self.parameter_dict:
-                root.debug("Parameter \"{0}\": {1}".format(param, self.parameter_dict[param]))
-                cmd = dc.DeviceCommand(param, "write", self.device, self.parameter_dict[param])
+            attr_pairs = list(self.parameter_dict.items())
+            root.debug("Parameters: {0}".format(attr_pairs))
+            if len(attr_pairs) > 0:
+                # All parameters are written in one request and read back in one request
+                cmd = dc.DeviceCommand("parameters", "write_attributes", self.device, attr_pairs)
                 cmd.add_condition(stop_delay_cmd)
                 cmd.add_subscriber(self.device_command_cb)
                 self.command_list.append(cmd)
                 prev_cmd = cmd
                 cmd.start()
-                cmd = dc.DeviceCommand(param, "read", self.device)
+                cmd = dc.DeviceCommand("parameters", "read_attributes", self.device,
+                                       [param for param, value in attr_pairs])
                 cmd.add_condition(prev_cmd)
                 cmd.add_subscriber(self.device_command_cb)
                 self.command_list.append(cmd)
@@ -343,6 +343,33 @@ class CameraDeviceController(object):
             self.command_list.append(cmd)
         root.debug("command list length: {0}".format(len(self.command_list)))
 
+    def write_attributes(self, attr_pairs):
+        """
+        Write several attribute values to camera device in one request. Issues three commands:
+        write_attributes
+        delay 0.1 s
+        read_attributes
+
+        :param attr_pairs: List of (attribute name, value) tuples
+        :return:
+        """
+        root.debug("Adding Write_attributes {0}".format(attr_pairs))
+        with self.lock:
+            prev_cmd = dc.DeviceCommand("write_attributes", "write_attributes", self.device, attr_pairs)
+            prev_cmd.add_subscriber(self.device_command_cb)
+            prev_cmd.start()
+            self.command_list.append(prev_cmd)
+            cmd_d = dc.DeviceCommand("delay_w", "delay", self.device, 0.1)
+            cmd_d.add_condition(prev_cmd)
+            cmd_d.start()
+            cmd = dc.DeviceCommand("read_attributes", "read_attributes", self.device,
+                                   [attr_name for attr_name, value in attr_pairs])
+            cmd.add_condition(cmd_d)
+            cmd.add_subscriber(self.device_command_cb)
+            cmd.start()
+            self.command_list.append(cmd)
+        root.debug("command list length: {0}".format(len(self.command_list)))
+
     def exec_command(self, cmd_name, data=None):
         """
         Execute a command on the camera device. No additional commands are sent.
@@ -530,6 +557,9 @@ class CameraDeviceController(object):
                     remove_list.append(cmd)
                     if cmd.operation == "read":
                         self.attribute_dict[cmd.name] = cmd.attr_result
+                    elif cmd.operation == "read_attributes" and cmd.attr_result is not None:
+                        for attr_name, attr in zip(cmd.data, cmd.attr_result):
+                            self.attribute_dict[attr_name] = attr
                     reset_flag = True
                 else:
                     if cmd.state is pt.DevState.UNKNOWN:
@@ -5,7 +5,6 @@ Created on Jan 18, 2018
 @author: Filip Lindau
 """
 import threading
-import Queue
 import time
 import PyTango as pt
 import PyTango.futures as ptf
@@ -77,7 +76,8 @@ class CameraDeviceController(object):
         self.schedule_list = list()
         self.schedule_timer = None
         self.process_after_result_flag = False
-        self.process_queue = Queue.Queue(2)
+        # At most one pass running and one waiting. Futures callbacks run the schedule directly in their thread.
+        self.process_semaphore = threading.BoundedSemaphore(2)
 
         self.attributes = dict()
 
@@ -202,6 +202,15 @@ class CameraDeviceController(object):
                 return False
             attr_future.add_done_callback(self._write_attribute_cb)
 
+    def _write_attributes(self, attr_pairs):
+        if self.device is not None:
+            try:
+                attr_future = self.device.write_attributes(attr_pairs, wait=False)
+            except pt.DevFailed as e:
+                root.error("write_attributes returned error {0}".format(str(e)))
+                return False
+            attr_future.add_done_callback(self._write_attribute_cb)
+
     def _write_attribute_cb(self, attr_future):
         root.info("write_attribute callback")
         if attr_future.cancelled() is True:
@@ -282,11 +291,12 @@ class CameraDeviceController(object):
         self.process_schedule()
 
     def process_schedule(self):
-        try:
-            self.process_queue.put(1, False)
-        except Queue.Full:
+        if self.process_semaphore.acquire(False) is False:
             return
-        self._process_schedule()
+        try:
+            self._process_schedule()
+        finally:
+            self.process_semaphore.release()
 
     def _process_schedule(self):
         with self.lock:
@@ -333,6 +343,8 @@ class CameraDeviceController(object):
                             self._read_attribute(exec_item.name)
                         elif exec_item.operation == "write":
                             self._write_attribute(exec_item.name, exec_item.data)
+                        elif exec_item.operation == "write_attributes":
+                            self._write_attributes(exec_item.data)
                         elif exec_item.operation == "command":
                             self._exec_command(exec_item.name, exec_item.data)
                         elif exec_item.operation == "delay":
@@ -347,7 +359,6 @@ class CameraDeviceController(object):
                     self.schedule_timer.start()
             else:
                 root.debug("State UNKNOWN, don't process schedule")
-        self.process_queue.get()
 
     def reset_watchdog(self):
         root.info("Resetting watchdog timer")
@@ -426,6 +437,15 @@ class CameraDeviceController(object):
         self.process_schedule()
         return sch_cmd
 
+    def write_attributes(self, attr_pairs, after_cmd=None):
+        root.info("Write attributes {0}".format(attr_pairs))
+        sch_cmd = ScheduleCommand("write_attributes", -1, "write_attributes", attr_pairs,
+                                  cmd_not_pending_list=after_cmd)
+        with self.lock:
+            bisect.insort(self.schedule_list, sch_cmd)
+        self.process_schedule()
+        return sch_cmd
+
     def exec_command(self, cmd_name, value=None, after_cmd=None):
         root.info("Execute command {0} with {1}".format(cmd_name, value))
         sch_cmd = ScheduleCommand(cmd_name, -1, "command", value, cmd_not_pending_list=after_cmd)
@@ -513,6 +533,7 @@ if __name__ == "__main__":
     roi = [0, 0, 1394, 1040]
     cmd0 = cam.exec_command("stop")
     cmd_d = cam.delay_command(0.5, after_cmd=cmd0)
-    cmd1 = cam.write_attribute("imageoffsetx", roi[0], after_cmd=cmd_d)
+    cmd1 = cam.write_attributes([("imageoffsetx", roi[0]), ("imageoffsety", roi[1]),
+                                 ("imagewidth", roi[2]), ("imageheight", roi[3])], after_cmd=cmd_d)
     cam.exec_command("start", after_cmd=[cmd1])
 
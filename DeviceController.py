@@ -5,7 +5,6 @@ Created on Feb 06, 2018
 @author: Filip Lindau
 """
 import threading
-import Queue
 import time
 import PyTango as pt
 import PyTango.futures as ptf
@@ -43,6 +42,14 @@ class Condition(object):
         self.range_type = range_type
         if self.range_type is None:
             self._determine_range_type()
+        # Enum ranges are only used for containment checks, so freeze them to sets once here
+        self._valid_set = None
+        self._invalid_set = None
+        if self.range_type == "enum":
+            if self.valid_range is not None:
+                self._valid_set = frozenset(self.valid_range)
+            if self.invalid_range is not None:
+                self._invalid_set = frozenset(self.invalid_range)
 
         self.fulfilled = False
 
@@ -66,10 +73,10 @@ class Condition(object):
                     if self.invalid_range is not None:
                         result = not self.invalid_range[0] < attr.value < self.invalid_range[1]
                 elif self.range_type == "enum":
-                    if self.valid_range is not None:
-                        result = attr.value in self.valid_range
-                    if self.invalid_range is not None:
-                        result = attr.value not in self.invalid_range
+                    if self._valid_set is not None:
+                        result = attr.value in self._valid_set
+                    if self._invalid_set is not None:
+                        result = attr.value not in self._invalid_set
             else:
                 result = True
         else:
@@ -145,7 +152,7 @@ class DeviceCommand(object):
         with self.subscriber_lock:
             for subscriber in self.subscriber_list:
                 try:
-                    root.debug("Calling subscriber {0}".format(subscriber))
+                    root.debug("Calling subscriber %s", subscriber)
                     subscriber(self)
                 except NameError:
                     remove_list.append(subscriber)
@@ -157,7 +164,7 @@ class DeviceCommand(object):
         #     self.remove_subscribers(rem_sub)
 
     def start(self):
-        root.debug("Starting command \"{0}\"".format(self.name))
+        root.debug("Starting command \"%s\"", self.name)
         try:
             self.delay_timer.cancel()
         except AttributeError:
@@ -192,7 +199,7 @@ class DeviceCommand(object):
         self.status_msg = "Command cancelled"
 
     def check_condition(self, cond_obj=None):
-        root.debug("Check conditions for \"{0}\"".format(self.name))
+        root.debug("Check conditions for \"%s\"", self.name)
         remove_list = []
         with self.condition_lock:
             if cond_obj is None:
@@ -200,21 +207,17 @@ class DeviceCommand(object):
                     try:
                         if cond.done is True:
                             result = self.condition_dict[cond].check_condition()
-                            root.debug("DeviceCommand \"{0}\" checking condition \"{1}\": {2}".format(self.name,
-                                                                                                      cond.name,
-                                                                                                      result))
+                            root.debug("DeviceCommand \"%s\" checking condition \"%s\": %s", self.name, cond.name, result)
                             # if result is True:
                             #     remove_list.append(cond)
                     except NameError:
                         remove_list.append(cond)
             else:
                 try:
-                    root.debug("Condition status: {0}".format(cond_obj.done))
+                    root.debug("Condition status: %s", cond_obj.done)
                     if cond_obj.done is True and cond_obj in self.condition_dict:
                         result = self.condition_dict[cond_obj].check_condition()
-                        root.debug("DeviceCommand \"{0}\" checking condition \"{1}\": {2}".format(self.name,
-                                                                                                  cond_obj.name,
-                                                                                                  result))
+                        root.debug("DeviceCommand \"%s\" checking condition \"%s\": %s", self.name, cond_obj.name, result)
                         # if result is True:
                         #     remove_list.append(cond_obj)
                 except NameError:
@@ -244,13 +247,15 @@ class DeviceCommand(object):
         return self.attr_result
 
     def execute_operation(self):
-        root.debug("Starting execution of operation {0} for \"{1}\", pending {2}".format(self.operation.upper(),
-                                                                                         self.name, self.pending))
+        root.debug("Starting execution of operation %s for \"%s\", pending %s", self.operation.upper(),
+                   self.name, self.pending)
         if self.pending is True:
             if self.operation == "read":
                 self._read_attribute()
             elif self.operation == "write":
                 self._write_attribute()
+            elif self.operation == "write_attributes":
+                self._write_attributes()
             elif self.operation == "command":
                 self._exec_command()
             elif self.operation == "delay":
@@ -259,7 +264,7 @@ class DeviceCommand(object):
                 self._read_attributes()
 
     def exec_post_actions(self):
-        root.debug("Executing post actions for {0}".format(self.name))
+        root.debug("Executing post actions for %s", self.name)
         self.pending = False
         if self.state == pt.DevState.ON:
             self.done = True
@@ -271,7 +276,7 @@ class DeviceCommand(object):
         self.notify_subscribers()
 
     def _read_attribute(self):
-        root.info("Sending read attribute \"{0}\" to device".format(self.name))
+        root.info("Sending read attribute \"%s\" to device", self.name)
         if self.device is not None:
             try:
                 attr_future = self.device.read_attribute(self.name, wait=False)
@@ -302,6 +307,17 @@ class DeviceCommand(object):
                 return False
             attr_future.add_done_callback(self._attribute_cb)
 
+    def _write_attributes(self):
+        root.info("Sending write attributes \"{0}\" to device".format(self.data))
+        if self.device is not None:
+            try:
+                attr_future = self.device.write_attributes(self.data, wait=False)
+            except pt.DevFailed as e:
+                root.error("write_attributes returned error {0}".format(str(e)))
+                self.status_msg = e[0].desc
+                return False
+            attr_future.add_done_callback(self._attribute_cb)
+
     def _exec_command(self):
         if self.device is not None:
             try:
@@ -323,7 +339,7 @@ class DeviceCommand(object):
         self.delay_timer.start()
 
     def _attribute_cb(self, attr_future=None):
-        root.info("\"{0}\" _attribute callback".format(self.name))
+        root.info("\"%s\" _attribute callback", self.name)
         if attr_future is not None:
             if attr_future.cancelled() is True:
                 root.error("Attribute future cancelled")
@@ -371,8 +387,9 @@ class DeviceCommand(object):
             attr = None
         self.attr_result = attr     # Save result
         if attr is not None:
-            root.debug("Attribute \"{0}\" result received".format(attr.name))
-            self.status_msg = "Attribute \"{0}\" result received".format(attr.name)
+            # read_attributes returns a list, so use the command name
+            root.debug("Attribute \"%s\" result received", self.name)
+            self.status_msg = "Attribute \"{0}\" result received".format(self.name)
         self.exec_post_actions()
 
     def _timeout_cb(self):
@@ -437,7 +454,7 @@ class AttributeWrapper(object):
             self.attr_result = attr.get_attribute()
         else:
             self.attr_result = attr
-        root.debug("set attribute \"{0}\" to value {1}".format(self.name, self.attr_result.value))
+        root.debug("set attribute \"%s\" to value %s", self.name, self.attr_result.value)
         self.notify_subscribers()
 
 
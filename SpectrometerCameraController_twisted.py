@@ -8,9 +8,15 @@ import threading
 import time
 import logging
 import traceback
-import Queue
 from concurrent.futures import Future
-from twisted.internet import reactor, defer, error
+from twisted.internet import error
+# Use the epoll reactor where available, it must be installed before the default reactor is imported
+try:
+    from twisted.internet import epollreactor
+    epollreactor.install()
+except (ImportError, error.ReactorAlreadyInstalledError):
+    pass
+from twisted.internet import reactor, defer
 from twisted.internet.protocol import Protocol, ClientFactory, Factory
 from twisted.python.failure import Failure, reflect
 import PyTango as tango
@@ -21,15 +27,32 @@ from TangoTwisted import TangoAttributeFactory, TangoAttributeProtocol, \
 import numpy as np
 
 logger = logging.getLogger("SpectrometerCameraController")
-while len(logger.handlers):
-    logger.removeHandler(logger.handlers[0])
 
-# f = logging.Formatter("%(asctime)s - %(module)s.   %(funcName)s - %(levelname)s - %(message)s")
-f = logging.Formatter("%(asctime)s - %(name)s.   %(funcName)s - %(levelname)s - %(message)s")
-fh = logging.StreamHandler()
-fh.setFormatter(f)
-logger.addHandler(fh)
-logger.setLevel(logging.DEBUG)
+
+def configure_logging():
+    """
+    Install a single stream handler on the SpectrometerCameraController logger, replacing any
+    existing handlers. Called once by the entry point instead of at import, so that importing or
+    reloading the modules does not reinstall handlers.
+    """
+    del logger.handlers[:]
+    # f = logging.Formatter("%(asctime)s - %(module)s.   %(funcName)s - %(levelname)s - %(message)s")
+    f = logging.Formatter("%(asctime)s - %(name)s.   %(funcName)s - %(levelname)s - %(message)s")
+    fh = logging.StreamHandler()
+    fh.setFormatter(f)
+    logger.addHandler(fh)
+    logger.setLevel(logging.DEBUG)
+
+
+def notifier_key(method):
+    """
+    Identity key for a notifier callable. A bound method is a new object on every attribute
+    access, so it is keyed on the instance and function it wraps rather than on its own id.
+
+    :param method: Callable to generate key for
+    :return: Hashable key
+    """
+    return id(getattr(method, "__self__", None)), id(getattr(method, "__func__", method))
 
 
 class MonitorAttribute(object):
@@ -68,6 +91,13 @@ class MonitorAttribute(object):
 
 
 class SpectrometerCameraController(object):
+    # Fixed attribute set, get_state/get_status are called from tango client threads on every poll
+    __slots__ = ("device_names", "device_factory_dict", "_factory_by_alias", "logger",
+                 "running_attr_params", "standby_attr_params", "event_attr_params",
+                 "camera_result", "_result_lock", "_latest_image", "_image_cond", "_image_generation",
+                 "looping_calls", "event_subscriptions", "_event_lock", "setup_params",
+                 "state_lock", "status", "state", "state_notifier_dict", "_not_found_failure")
+
     def __init__(self, camera_name, start=False):
         """
         Controller for running a spectrometer. Communicates with a camera looking at a spectrum.
@@ -80,24 +110,30 @@ class SpectrometerCameraController(object):
         self.device_names["camera"] = camera_name
 
         self.device_factory_dict = dict()
+        # Same factories keyed by the short device name used in the operations, e.g. "camera"
+        self._factory_by_alias = dict()
 
         self.logger = logging.getLogger("SpectrometerCameraController.Controller")
         self.logger.setLevel(logging.WARNING)
         self.logger.info("SpectrometerCameraController.__init__")
 
+        # Attributes polled with looping calls, value is the polling period
         self.running_attr_params = dict()
-        self.running_attr_params["state"] = 0.2
-        self.running_attr_params["gain"] = 2.0
-        self.running_attr_params["exposuretime"] = 2.0
-        self.running_attr_params["image"] = 0.1
+        self.running_attr_params["image"] = 0.2
 
         self.standby_attr_params = dict()
-        self.standby_attr_params["state"] = 0.2
-        self.standby_attr_params["gain"] = 2.0
-        self.standby_attr_params["exposuretime"] = 2.0
+
+        # Attributes monitored with change events in both running and standby.
+        # Value is the polling period used if the device does not send change events.
+        self.event_attr_params = dict()
+        self.event_attr_params["state"] = 0.2
+        self.event_attr_params["gain"] = 2.0
+        self.event_attr_params["exposuretime"] = 2.0
 
         # Dictionary where read and constructed tango attributes are stored.
         # Assume None or tango.DeviceAttribute
+        # The dict is never modified once published. store_results replaces it with an updated copy,
+        # so readers take self.camera_result without locking and get a consistent snapshot.
         self.camera_result = dict()
         self.camera_result["state"] = None
         self.camera_result["gain"] = None
@@ -109,8 +145,19 @@ class SpectrometerCameraController(object):
         self.camera_result["satlvl"] = None
         self.camera_result["max_value"] = None
         self.camera_result["spectrum"] = None
+        self._result_lock = threading.Lock()    # Serializes writers of camera_result, readers do not take it
+
+        # Single slot for camera images waiting for spectrum calculation. A new image replaces
+        # an unprocessed one so that a slow calculation never builds up a backlog.
+        # The worker waits on _image_cond. Stopping the processing changes _image_generation,
+        # which wakes the worker of the old generation so that it can exit.
+        self._latest_image = None
+        self._image_cond = threading.Condition(threading.Lock())
+        self._image_generation = 0
 
         self.looping_calls = list()
+        self.event_subscriptions = list()   # (factory, event id) tuples
+        self._event_lock = threading.Lock()     # Recording and removing subscriptions
 
         self.setup_params = dict()
         self.setup_params["triggermode"] = "Off"
@@ -124,55 +171,111 @@ class SpectrometerCameraController(object):
         self.state_lock = threading.Lock()
         self.status = ""
         self.state = "unknown"
-        self.state_notifier_list = list()       # Methods in this list will be called when the state
-        # or status message is changed
+        self.state_notifier_dict = dict()       # Methods in this dict will be called when the state
+        # or status message is changed. Keyed by notifier_key.
+
+        # Returned by the device operations when the device name is not used by this controller
+        err = tango.DevError(reason="Device not used",
+                             severety=tango.ErrSeverity.ERR,
+                             desc="The device is not in the list of devices used by this controller",
+                             origin="SpectrometerCameraController")
+        self._not_found_failure = Failure(tango.DevFailed(err))
 
         if start is True:
-            self.device_factory_dict["camera"] = TangoAttributeFactory(camera_name)
+            self.set_device_factory("camera", TangoAttributeFactory(camera_name))
 
             for dev_fact in self.device_factory_dict:
                 self.device_factory_dict[dev_fact].startFactory()
 
+    def set_device_factory(self, device_name, factory):
+        """
+        Store the TangoAttributeFactory used for a device.
+
+        :param device_name: Name of the device in the device_names dict, e.g. "camera"
+        :param factory: TangoAttributeFactory for the device
+        :return:
+        """
+        self.device_factory_dict[self.device_names[device_name]] = factory
+        self._factory_by_alias[device_name] = factory
+
+    def clear_device_factories(self):
+        self.device_factory_dict = dict()
+        self._factory_by_alias = dict()
+
+    def set_attr_periods(self, attr_periods):
+        """
+        Update the polling periods of monitored attributes. Takes effect the next time a state
+        starts its looping calls. For event monitored attributes the period is used as fallback
+        if the device does not send change events.
+
+        :param attr_periods: Dict of attribute name: polling period in s
+        :return:
+        """
+        for key, period in attr_periods.items():
+            if key in self.event_attr_params:
+                self.event_attr_params[key] = period
+            else:
+                self.running_attr_params[key] = period
+
     def read_attribute(self, name, device_name):
-        self.logger.info("Read attribute \"{0}\" on \"{1}\"".format(name, device_name))
-        if device_name in self.device_names:
-            factory = self.device_factory_dict[self.device_names[device_name]]
-            d = factory.buildProtocol("read", name)
-        else:
-            self.logger.error("Device name {0} not found among {1}".format(device_name, self.device_factory_dict))
-            err = tango.DevError(reason="Device {0} not used".format(device_name),
-                                 severety=tango.ErrSeverity.ERR,
-                                 desc="The device is not in the list of devices used by this controller",
-                                 origin="read_attribute")
-            d = Failure(tango.DevFailed(err))
+        self.logger.info("Read attribute \"%s\" on \"%s\"", name, device_name)
+        factory = self._factory_by_alias.get(device_name)
+        if factory is None:
+            self.logger.error("Device name {0} not found among {1}".format(device_name, self.device_names))
+            return defer.fail(self._not_found_failure)
+        d = factory.buildProtocol("read", name)
+        return d
+
+    def read_attributes(self, names, device_name):
+        """
+        Read several attributes on a device in a single Tango request.
+
+        :param names: List of attribute names
+        :param device_name: Name of the device in the device_names dict, e.g. "camera"
+        :return: Deferred that fires with a list of DeviceAttributes in the order of names
+        """
+        joined_names = ",".join(names)
+        self.logger.info("Read attributes \"{0}\" on \"{1}\"".format(joined_names, device_name))
+        factory = self._factory_by_alias.get(device_name)
+        if factory is None:
+            self.logger.error("Device name {0} not found among {1}".format(device_name, self.device_names))
+            return defer.fail(self._not_found_failure)
+        d = factory.buildProtocol("read_multi", joined_names, list(names))
         return d
 
     def write_attribute(self, name, device_name, data):
         self.logger.info("Write attribute \"{0}\" on \"{1}\"".format(name, device_name))
-        if device_name in self.device_names:
-            factory = self.device_factory_dict[self.device_names[device_name]]
-            d = factory.buildProtocol("write", name, data)
-        else:
-            self.logger.error("Device name {0} not found among {1}".format(device_name, self.device_factory_dict))
-            err = tango.DevError(reason="Device {0} not used".format(device_name),
-                                 severety=tango.ErrSeverity.ERR,
-                                 desc="The device is not in the list of devices used by this controller",
-                                 origin="write_attribute")
-            d = Failure(tango.DevFailed(err))
+        factory = self._factory_by_alias.get(device_name)
+        if factory is None:
+            self.logger.error("Device name {0} not found among {1}".format(device_name, self.device_names))
+            return defer.fail(self._not_found_failure)
+        d = factory.buildProtocol("write", name, data)
+        return d
+
+    def write_attributes(self, pairs, device_name):
+        """
+        Write several attributes on a device in a single Tango request.
+
+        :param pairs: List of (attribute name, value) tuples
+        :param device_name: Name of the device in the device_names dict, e.g. "camera"
+        :return: Deferred that fires when the write is completed
+        """
+        names = ",".join([p[0] for p in pairs])
+        self.logger.info("Write attributes \"{0}\" on \"{1}\"".format(names, device_name))
+        factory = self._factory_by_alias.get(device_name)
+        if factory is None:
+            self.logger.error("Device name {0} not found among {1}".format(device_name, self.device_names))
+            return defer.fail(self._not_found_failure)
+        d = factory.buildProtocol("write_multi", names, pairs)
         return d
 
     def send_command(self, name, device_name, data):
         self.logger.info("Send command \"{0}\" on \"{1}\"".format(name, device_name))
-        if device_name in self.device_names:
-            factory = self.device_factory_dict[self.device_names[device_name]]
-            d = factory.buildProtocol("command", name, data)
-        else:
-            self.logger.error("Device name {0} not found among {1}".format(device_name, self.device_factory_dict))
-            err = tango.DevError(reason="Device {0} not used".format(device_name),
-                                 severety=tango.ErrSeverity.ERR,
-                                 desc="The device is not in the list of devices used by this controller",
-                                 origin="write_attribute")
-            d = Failure(tango.DevFailed(err))
+        factory = self._factory_by_alias.get(device_name)
+        if factory is None:
+            self.logger.error("Device name {0} not found among {1}".format(device_name, self.device_names))
+            return defer.fail(self._not_found_failure)
+        d = factory.buildProtocol("command", name, data)
         return d
 
     def check_attribute(self, attr_name, dev_name, target_value, period=0.3, timeout=1.0, tolerance=None, write=True):
@@ -195,30 +298,75 @@ class SpectrometerCameraController(object):
         :return: Deferred that will fire depending on the result of the check
         """
         self.logger.info("Check attribute \"{0}\" on \"{1}\"".format(attr_name, dev_name))
-        if dev_name in self.device_names:
-            factory = self.device_factory_dict[self.device_names[dev_name]]
-            d = factory.buildProtocol("check", attr_name, None, write=write, target_value=target_value,
-                                      tolerance=tolerance, period=period, timeout=timeout)
-            d.addCallback(self.update_attribute)
-        else:
-            self.logger.error("Device name {0} not found among {1}".format(dev_name, self.device_factory_dict))
-            err = tango.DevError(reason="Device {0} not used".format(dev_name),
-                                 severety=tango.ErrSeverity.ERR,
-                                 desc="The device is not in the list of devices used by this controller",
-                                 origin="check_attribute")
-            d = Failure(tango.DevFailed(err))
+        factory = self._factory_by_alias.get(dev_name)
+        if factory is None:
+            self.logger.error("Device name {0} not found among {1}".format(dev_name, self.device_names))
+            return defer.fail(self._not_found_failure)
+        d = factory.buildProtocol("check", attr_name, None, write=write, target_value=target_value,
+                                  tolerance=tolerance, period=period, timeout=timeout)
+        d.addCallback(self.update_attribute)
         return d
 
+    def subscribe_event(self, name, device_name, callback, is_active=None):
+        """
+        Subscribe to change events for an attribute. The subscription is stored so that it
+        can be removed with unsubscribe_events.
+
+        :param name: Tango name of the attribute
+        :param device_name: Name of the device in the device_names dict, e.g. "camera"
+        :param callback: Called with the new DeviceAttribute each time the attribute changes
+        :param is_active: Optional callable. If it returns False when the subscription is done, the
+        subscriber has stopped meanwhile and the event is unsubscribed instead of stored.
+        :return: Deferred that fires with the event id when the subscription is done, or None if
+        it was unsubscribed
+        """
+        self.logger.info("Subscribe to events for \"{0}\" on \"{1}\"".format(name, device_name))
+        factory = self._factory_by_alias.get(device_name)
+        if factory is None:
+            self.logger.error("Device name {0} not found among {1}".format(device_name, self.device_names))
+            return defer.fail(self._not_found_failure)
+        d = factory.subscribe_event(name, callback)
+        d.addCallback(self._event_subscribed, factory, is_active)
+        return d
+
+    def _event_subscribed(self, event_id, factory, is_active):
+        # Checked under the lock, so a subscriber that stops later finds the event in unsubscribe_events
+        with self._event_lock:
+            keep = is_active is None or is_active() is True
+            if keep is True:
+                self.event_subscriptions.append((factory, event_id))
+        if keep is False:
+            self.logger.info("Subscriber stopped, unsubscribing event {0}".format(event_id))
+            try:
+                factory.unsubscribe_event(event_id)
+            except Exception as e:
+                self.logger.error("Could not unsubscribe event {0}: {1}".format(event_id, e))
+            return None
+        return event_id
+
+    def unsubscribe_events(self):
+        with self._event_lock:
+            event_subscriptions, self.event_subscriptions = self.event_subscriptions, list()
+        for factory, event_id in event_subscriptions:
+            try:
+                factory.unsubscribe_event(event_id)
+            except Exception as e:
+                self.logger.error("Could not unsubscribe event {0}: {1}".format(event_id, e))
+
     def get_state(self):
         with self.state_lock:
             st = self.state
         return st
 
     def set_state(self, state):
+        # Call the notifiers outside the lock so that slow notifiers don't block get_state
         with self.state_lock:
+            if state == self.state:
+                return
             self.state = state
-            for m in self.state_notifier_list:
-                m(self.state, self.status)
+            status = self.status
+            notifiers = tuple(self.state_notifier_dict.values())
+        self._dispatch_notifiers(notifiers, state, status)
 
     def get_status(self):
         with self.state_lock:
@@ -228,32 +376,132 @@ class SpectrometerCameraController(object):
     def set_status(self, status_msg):
         self.logger.debug("Status: {0}".format(status_msg))
         with self.state_lock:
+            if status_msg == self.status:
+                return
             self.status = status_msg
-            for m in self.state_notifier_list:
-                m(self.state, self.status)
+            state = self.state
+            notifiers = tuple(self.state_notifier_dict.values())
+        self._dispatch_notifiers(notifiers, state, status_msg)
 
-    def get_attribute(self, attr_name):
+    def set_state_and_status(self, state, status_msg):
+        """
+        Set state and status together, calling the state notifiers once.
+
+        :param state: New state name
+        :param status_msg: New status message
+        :return:
+        """
+        self.logger.debug("State: {0}, status: {1}".format(state, status_msg))
         with self.state_lock:
-            try:
-                res = self.camera_result[attr_name]
-            except KeyError:
-                res = None
-            return res
+            if state == self.state and status_msg == self.status:
+                return
+            self.state = state
+            self.status = status_msg
+            notifiers = tuple(self.state_notifier_dict.values())
+        self._dispatch_notifiers(notifiers, state, status_msg)
+
+    def _dispatch_notifiers(self, notifiers, state, status_msg):
+        """
+        Call all notifiers for one state change. If the twisted reactor is running they are
+        called in the reactor thread with a single callFromThread for the whole group,
+        otherwise directly in the calling thread.
+        """
+        if reactor.running is True:
+            reactor.callFromThread(self._run_notifiers, notifiers, state, status_msg)
+        else:
+            self._run_notifiers(notifiers, state, status_msg)
+
+    @staticmethod
+    def _run_notifiers(notifiers, state, status_msg):
+        for m in notifiers:
+            m(state, status_msg)
+
+    def get_attribute(self, attr_name):
+        return self.camera_result.get(attr_name)
+
+    def store_results(self, results):
+        """
+        Store results in camera_result by publishing an updated copy of the dict. Results stored
+        in the same call become visible to readers together.
+
+        :param results: Dict of attribute name: result
+        :return:
+        """
+        with self._result_lock:
+            new_result = dict(self.camera_result)
+            new_result.update(results)
+            self.camera_result = new_result
+
+    def start_image_processing(self):
+        """
+        Start a new generation of image processing. A worker passes the returned generation to
+        take_image until it returns None.
+
+        :return: Generation number
+        """
+        with self._image_cond:
+            self._image_generation += 1
+            self._latest_image = None
+            return self._image_generation
+
+    def stop_image_processing(self):
+        """
+        Stop the current generation of image processing, waking a worker waiting in take_image.
+
+        :return:
+        """
+        with self._image_cond:
+            self._image_generation += 1
+            self._latest_image = None
+            self._image_cond.notify_all()
+
+    def put_image(self, image):
+        """
+        Store a new camera image for spectrum calculation, replacing any image not yet processed,
+        and wake the worker waiting in take_image.
+
+        :param image: DeviceAttribute with the camera image
+        :return:
+        """
+        with self._image_cond:
+            dropped = self._latest_image is not None
+            self._latest_image = image
+            self._image_cond.notify()
+        if dropped is True:
+            self.logger.warning("Dropped frame, spectrum calculation not keeping up")
+
+    def take_image(self, generation):
+        """
+        Wait for the latest unprocessed camera image and take it.
+
+        :param generation: Generation returned by start_image_processing
+        :return: DeviceAttribute with the camera image, or None when the generation is stopped
+        """
+        with self._image_cond:
+            # Waits without timeout, a timed wait polls on python 2
+            while self._latest_image is None and generation == self._image_generation:
+                self._image_cond.wait()
+            if generation != self._image_generation:
+                return None
+            image = self._latest_image
+            self._latest_image = None
+        return image
 
     def add_state_notifier(self, state_notifier_method):
-        self.state_notifier_list.append(state_notifier_method)
+        with self.state_lock:
+            self.state_notifier_dict[notifier_key(state_notifier_method)] = state_notifier_method
 
     def remove_state_notifier(self, state_notifier_method):
-        try:
-            self.state_notifier_list.remove(state_notifier_method)
-        except ValueError:
+        with self.state_lock:
+            m = self.state_notifier_dict.pop(notifier_key(state_notifier_method), None)
+        if m is None:
             self.logger.warning("Method {0} not in list. Ignoring.".format(state_notifier_method))
 
     def update_attribute(self, result):
-        self.logger.info("Updating attribute with {0}".format(result))
+        self.logger.info("Updating attribute with %s", result)
         try:
             attr_name = result.name
         except AttributeError:
             return result
-        self.camera_result[attr_name] = result
+        self.store_results({attr_name: result})
         return result
@@ -10,23 +10,22 @@ import PyTango as tango
 from PyTango.server import Device, DeviceMeta
 from PyTango.server import attribute, command
 from PyTango.server import device_property
-from SpectrometerCameraController_twisted import SpectrometerCameraController
+from SpectrometerCameraController_twisted import SpectrometerCameraController, configure_logging
 from SpectrometerCameraState import StateDispatcher
 from CameraDeviceController_2 import CameraDeviceController
+from SpectrumKernels import wavelength_vector
 import numpy as np
 import logging
 
 
 logger = logging.getLogger("SpectrometerCameraController")
-logger.setLevel(logging.DEBUG)
-while len(logger.handlers):
-    logger.removeHandler(logger.handlers[0])
 
-f = logging.Formatter("%(asctime)s - %(name)s.   %(funcName)s - %(levelname)s - %(message)s")
-fh = logging.StreamHandler()
-fh.setFormatter(f)
-logger.addHandler(fh)
-logger.setLevel(logging.DEBUG)
+# Controller state name to tango state. Names not in the dict map to UNKNOWN.
+_STATE_MAP = {"running": tango.DevState.RUNNING,
+              "on": tango.DevState.ON,
+              "device_connect": tango.DevState.INIT,
+              "setup_attributes": tango.DevState.INIT,
+              "fault": tango.DevState.FAULT}
 
 
 class SpectrometerCameraDS(Device):
@@ -68,7 +67,7 @@ class SpectrometerCameraDS(Device):
                                  )
 
     spectrum = attribute(label='Spectrum',
-                         dtype=[np.double],
+                         dtype=[np.float32],
                          access=tango.AttrWriteType.READ,
                          max_dim_x=16384,
                          display_level=tango.DispLevel.OPERATOR,
@@ -133,18 +132,28 @@ class SpectrometerCameraDS(Device):
                           doc="Saturation pixel value, used for estimating overexposure",
                           default_value=65536)
 
+    image_poll_period = device_property(dtype=float,
+                                        doc="Polling period for the camera image in s",
+                                        default_value="0.2")
+
     def __init__(self, klass, name):
         self.wavelengthvector_data = np.array([])
+        self._wavelength_time = time.time()
+        self._wavelength_attr = None
+        self._wavelength_key = None
+        self._max_value_attr = None
         self.max_value = 1.0
         self.controller = None              # type: SpectrometerCameraController
         self.state_dispatcher = None        # type: StateDispatcher
         self.db = None
+        self._memorized = dict()            # Memorized attribute values, written to the camera after init
         Device.__init__(self, klass, name)
 
     def init_device(self):
         self.debug_stream("In init_device:")
         Device.init_device(self)
         self.db = tango.Database()
+        self._memorized = self._read_memorized()
         self.set_state(tango.DevState.UNKNOWN)
         try:
             if self.state_dispatcher is not None:
@@ -173,114 +182,122 @@ class SpectrometerCameraDS(Device):
         params["imageheight"] = self.roi[3]
         params["triggermode"] = "Off"
         self.controller.setup_params = params
+        attr_periods = dict()
+        attr_periods["image"] = self.image_poll_period
+        attr_periods["gain"] = 2.0
+        attr_periods["exposuretime"] = 2.0
+        attr_periods["state"] = 0.2
+        self.controller.set_attr_periods(attr_periods)
 
     def setup_spectrometer(self):
         self.info_stream("Entering setup_camera")
-        self.wavelengthvector_data = (self.central_wavelength + np.arange(-self.roi[2] / 2,
-                                                                          self.roi[2] / 2) * self.dispersion) * 1e-9
+        # The wavelength vector and its attribute only depend on the spectrometer properties,
+        # so they are rebuilt only when one of them changed since the last init
+        wavelength_key = (self.central_wavelength, self.dispersion, self.roi[2])
+        if self._wavelength_attr is None or wavelength_key != self._wavelength_key:
+            self.wavelengthvector_data = wavelength_vector(self.central_wavelength, self.dispersion, self.roi[2])
+            wavelength_attr = tango.DeviceAttribute()
+            wavelength_attr.name = "wavelengths"
+            wavelength_attr.quality = tango.AttrQuality.ATTR_VALID
+            wavelength_attr.value = self.wavelengthvector_data
+            # wavelength_attr.data_format = tango.AttrDataFormat.SPECTRUM
+            self._wavelength_attr = wavelength_attr
+            self._wavelength_key = wavelength_key
+        self._wavelength_time = time.time()
+        self._wavelength_attr.time = tango.time_val.TimeVal(self._wavelength_time)
         self.max_value = self.saturation_level
-        wavelength_attr = tango.DeviceAttribute()
-        wavelength_attr.name = "wavelengths"
-        wavelength_attr.quality = tango.AttrQuality.ATTR_VALID
-        wavelength_attr.value = self.wavelengthvector_data
-        # wavelength_attr.data_format = tango.AttrDataFormat.SPECTRUM
-        wavelength_attr.time = tango.time_val.TimeVal(time.time())
-        max_value_attr = tango.DeviceAttribute()
-        max_value_attr.name = "max_value"
-        max_value_attr.quality = tango.AttrQuality.ATTR_VALID
-        max_value_attr.value = self.max_value
-        # max_value_attr.data_format = tango.AttrDataFormat.SCALAR
-        max_value_attr.time = tango.time_val.TimeVal(time.time())
-        with self.controller.state_lock:
-            self.controller.camera_result["wavelengths"] = wavelength_attr
-            self.controller.camera_result["max_value"] = max_value_attr
+        if self._max_value_attr is None or self._max_value_attr.value != self.max_value:
+            max_value_attr = tango.DeviceAttribute()
+            max_value_attr.name = "max_value"
+            max_value_attr.quality = tango.AttrQuality.ATTR_VALID
+            max_value_attr.value = self.max_value
+            # max_value_attr.data_format = tango.AttrDataFormat.SCALAR
+            self._max_value_attr = max_value_attr
+        self._max_value_attr.time = tango.time_val.TimeVal(self._wavelength_time)
+        self.controller.store_results({"wavelengths": self._wavelength_attr, "max_value": self._max_value_attr})
+
+    def _read_memorized(self):
+        """
+        Read the memorized gain and exposure time from the database. The values are cached
+        so that state changes do not query the database.
+
+        :return: Dict with the memorized values that were found
+        """
+        memorized = dict()
+        try:
+            data = self.db.get_device_attribute_property(self.get_name(), ["gain", "exposuretime"])
+            self.debug_stream("Database returned data for memorized attributes: {0}".format(data))
+        except (tango.DevFailed, TypeError) as e:
+            self.warn_stream("Could not read memorized attributes from database. {0}".format(e))
+            return memorized
+        for attr_name in ("gain", "exposuretime"):
+            try:
+                memorized[attr_name] = float(data[attr_name]["__value"][0])
+                self.debug_stream("{0}: {1}".format(attr_name, memorized[attr_name]))
+            except (KeyError, TypeError, IndexError, ValueError):
+                pass
+        return memorized
 
     def change_state(self, new_state, new_status=None):
-        self.info_stream("Change state: {0}, status {1}".format(new_state, new_status))
+        # Only format log messages when the device logger will emit them
+        debug = self.get_logger().is_debug_enabled()
+        if self.get_logger().is_info_enabled() is True:
+            self.info_stream("Change state: {0}, status {1}".format(new_state, new_status))
         # Map new_state string to tango state
-        if new_state in ["running"]:
-            tango_state = tango.DevState.RUNNING
-        elif new_state in ["on"]:
-            tango_state = tango.DevState.ON
-        elif new_state in ["device_connect", "setup_attributes"]:
-            tango_state = tango.DevState.INIT
-        elif new_state in ["fault"]:
-            tango_state = tango.DevState.FAULT
-        else:
-            tango_state = tango.DevState.UNKNOWN
+        tango_state = _STATE_MAP.get(new_state, tango.DevState.UNKNOWN)
 
         # Set memorized attributes when entering init from unknown state:
         if self.get_state() is tango.DevState.INIT and new_state is not tango.DevState.UNKNOWN:
-            self.debug_stream("Set memorized attributes")
-            try:
-                data = self.db.get_device_attribute_property(self.get_name(), "gain")
-                self.debug_stream("Database returned data for \"gain\": {0}".format(data["gain"]))
-            except TypeError as e:
-                self.warn_stream("Gain not found in database. {0}".format(e))
-            try:
-                new_value = float(data["gain"]["__value"][0])
-                self.debug_stream("{0}".format(new_value))
-                self.controller.write_attribute("gain", "camera", new_value)
-            except (KeyError, TypeError, IndexError, ValueError):
-                pass
-            try:
-                data = self.db.get_device_attribute_property(self.get_name(), "exposuretime")
-                self.debug_stream("Database returned data for \"exposuretime\": {0}".format(data["exposuretime"]))
-            except TypeError as e:
-                self.warn_stream("Exposuretime not found in database. {0}".format(e))
-            try:
-                new_value = float(data["exposuretime"]["__value"][0])
-                self.controller.write_attribute("exposuretime", "camera", new_value)
-            except (KeyError, TypeError, IndexError, ValueError):
-                pass
+            if debug is True:
+                self.debug_stream("Set memorized attributes")
+            pairs = [(attr_name, self._memorized[attr_name]) for attr_name in ("gain", "exposuretime")
+                     if attr_name in self._memorized]
+            if len(pairs) > 0:
+                self.controller.write_attributes(pairs, "camera")
 
         if tango_state != self.get_state():
-            self.debug_stream("Change state from {0} to {1}".format(self.get_state(), new_state))
+            if debug is True:
+                self.debug_stream("Change state from {0} to {1}".format(self.get_state(), new_state))
             self.set_state(tango_state)
-        if new_status is not None:
-            self.debug_stream("Setting status {0}".format(new_status))
+        if new_status is not None and new_status != self.get_status():
+            if debug is True:
+                self.debug_stream("Setting status {0}".format(new_status))
             self.set_status(new_status)
 
     def get_spectrum(self):
         attr = self.controller.get_attribute("spectrum")
-        try:
-            self.debug_stream("get_spectrum: {0}".format(attr.value.shape))
-        except Exception as e:
-            self.warn_stream("Could not format attribute: {0}".format(e))
         return attr.value, attr.time.totime(), attr.quality
 
     def get_wavelengthvector(self):
-        self.debug_stream("get_wavelengthvector: size {0}".format(self.wavelengthvector_data.shape))
-        attr = self.controller.get_attribute("wavelengths")
-        return attr.value, attr.time.totime(), attr.quality
+        # The wavelength vector only changes in setup_spectrometer, so serve it directly
+        return self.wavelengthvector_data, self._wavelength_time, tango.AttrQuality.ATTR_VALID
 
     def get_exposuretime(self):
         attr = self.controller.get_attribute("exposuretime")
-        try:
-            self.debug_stream("get_exposuretime: {0}".format(attr))
-        except Exception as e:
-            self.warn_stream("Could not format attribute: {0}".format(e))
         return attr.value, attr.time.totime(), attr.quality
 
     def set_exposuretime(self, new_exposuretime):
-        self.debug_stream("In set_exposuretime: New value {0}".format(new_exposuretime))
+        if self.get_logger().is_debug_enabled() is True:
+            self.debug_stream("In set_exposuretime: New value {0}".format(new_exposuretime))
         # self.controller.write_attribute("exposuretime", "camera", new_exposuretime)
         try:
             old_exposure = self.controller.get_attribute("exposuretime").value
         except AttributeError:
             old_exposure = 0.0
-        tol = np.abs(new_exposuretime - old_exposure) * 0.1
+        tol = abs(new_exposuretime - old_exposure) * 0.1
         self.controller.check_attribute("exposuretime", "camera", new_exposuretime,
                                         tolerance=tol, write=True)
+        self._memorized["exposuretime"] = new_exposuretime
 
     def get_gain(self):
         attr = self.controller.get_attribute("gain")
         return attr.value, attr.time.totime(), attr.quality
 
     def set_gain(self, new_gain):
-        self.debug_stream("In set_gain: New value {0}".format(new_gain))
+        if self.get_logger().is_debug_enabled() is True:
+            self.debug_stream("In set_gain: New value {0}".format(new_gain))
         self.controller.write_attribute("gain", "camera", new_gain)
-        self.controller.read_attribute("gain", "camera")
+        self._memorized["gain"] = new_gain
 
     def get_width(self):
         attr = self.controller.get_attribute("width")
@@ -308,4 +325,5 @@ class SpectrometerCameraDS(Device):
 
 
 if __name__ == "__main__":
+    configure_logging()
     tango.server.server_run((SpectrometerCameraDS,))
@@ -12,6 +12,7 @@ from PyTango.server import attribute
 from PyTango.server import device_property
 from SpectrometerCameraDeviceController import SpectrometerCameraDeviceController
 from CameraDeviceController_2 import CameraDeviceController
+from SpectrumKernels import wavelength_vector
 import numpy as np
 
 
@@ -56,7 +57,7 @@ class SpectrometerCameraDS(Device):
                                  )
 
     spectrum = attribute(label='Spectrum',
-                         dtype=[np.double],
+                         dtype=[np.float32],
                          access=pt.AttrWriteType.READ,
                          max_dim_x=16384,
                          display_level=pt.DispLevel.OPERATOR,
@@ -124,15 +125,19 @@ class SpectrometerCameraDS(Device):
 
     def __init__(self, klass, name):
         self.wavelengthvector_data = np.array([])
+        self._wv_time = time.time()
+        self._empty_spectrum = np.empty(0, dtype=np.float32)
         self.max_value = 1.0
         self.dev_controller = None
         self.db = None
+        self._memorized = dict()            # Memorized attribute values, written to the camera after init
         Device.__init__(self, klass, name)
 
     def init_device(self):
         self.debug_stream("In init_device:")
         Device.init_device(self)
         self.db = pt.Database()
+        self._memorized = self._read_memorized()
         self.set_state(pt.DevState.UNKNOWN)
         self.debug_stream("Init camera controller {0}".format(self.camera_name))
         params = dict()
@@ -162,62 +167,82 @@ class SpectrometerCameraDS(Device):
 
     def setup_spectrometer(self):
         self.info_stream("Entering setup_camera")
-        self.wavelengthvector_data = (self.central_wavelength + np.arange(-self.roi[2] / 2,
-                                                                          self.roi[2] / 2) * self.dispersion) * 1e-9
+        # The vector is constant until the next setup, read-only so it can be served without copying
+        self.wavelengthvector_data = wavelength_vector(self.central_wavelength, self.dispersion, self.roi[2])
+        self._wv_time = time.time()
         self.max_value = self.saturation_level
 
-    def change_state(self, new_state, new_status=None):
-        self.debug_stream("Change state from {0} to {1}".format(self.get_state(), new_state))
-        if self.get_state() is pt.DevState.INIT and new_state is not pt.DevState.UNKNOWN:
-            self.debug_stream("Set memorized attributes")
-            data = self.db.get_device_attribute_property(self.get_name(), "gain")
-            self.debug_stream("Database returned data for \"gain\": {0}".format(data["gain"]))
-            try:
-                new_value = float(data["gain"]["__value"][0])
-                self.debug_stream("{0}".format(new_value))
-                self.dev_controller.write_attribute("gain", new_value)
-            except (KeyError, TypeError, IndexError, ValueError):
-                pass
-            data = self.db.get_device_attribute_property(self.get_name(), "exposuretime")
-            self.debug_stream("Database returned data for \"exposuretime\": {0}".format(data["exposuretime"]))
+    def _read_memorized(self):
+        """
+        Read the memorized gain and exposure time from the database once per init_device.
+
+        :return: Dict with the memorized values that were found
+        """
+        memorized = dict()
+        try:
+            data = self.db.get_device_attribute_property(self.get_name(), ["gain", "exposuretime"])
+            self.debug_stream("Database returned data for memorized attributes: {0}".format(data))
+        except (pt.DevFailed, TypeError) as e:
+            self.warn_stream("Could not read memorized attributes from database. {0}".format(e))
+            return memorized
+        for attr_name in ("gain", "exposuretime"):
             try:
-                new_value = float(data["exposuretime"]["__value"][0])
-                self.dev_controller.write_attribute("exposuretime", new_value)
+                memorized[attr_name] = float(data[attr_name]["__value"][0])
+                self.debug_stream("{0}: {1}".format(attr_name, memorized[attr_name]))
             except (KeyError, TypeError, IndexError, ValueError):
                 pass
-        self.set_state(new_state)
-        if new_status is not None:
-            self.debug_stream("Setting status {0}".format(new_status))
+        return memorized
+
+    def change_state(self, new_state, new_status=None):
+        # Only format log messages when the device logger will emit them
+        debug = self.get_logger().is_debug_enabled()
+        if debug is True:
+            self.debug_stream("Change state from {0} to {1}".format(self.get_state(), new_state))
+        if self.get_state() is pt.DevState.INIT and new_state is not pt.DevState.UNKNOWN:
+            if debug is True:
+                self.debug_stream("Set memorized attributes")
+            attr_pairs = [(attr_name, self._memorized[attr_name]) for attr_name in ("gain", "exposuretime")
+                          if attr_name in self._memorized]
+            if len(attr_pairs) > 0:
+                self.dev_controller.write_attributes(attr_pairs)
+        # The controller re-broadcasts unchanged states, only touch the device when something changed
+        if new_state != self.get_state():
+            self.set_state(new_state)
+        if new_status is not None and new_status != self.get_status():
+            if debug is True:
+                self.debug_stream("Setting status {0}".format(new_status))
             self.set_status(new_status)
 
     def get_spectrum(self):
-        attr = self.dev_controller.get_attribute("image")
-        try:
-            spectrum = attr.value.sum(0)
-        except AttributeError:
-            spectrum = []
-        return spectrum, attr.time.totime(), attr.quality
+        # The controller publishes a (spectrum, time, quality) tuple for every image read, with an empty
+        # INVALID spectrum for frames it can not reduce, so the stored tuple matches the current image
+        attr = self.dev_controller.get_attribute("spectrum")
+        if attr is None:
+            return self._empty_spectrum, time.time(), pt.AttrQuality.ATTR_INVALID
+        return attr
 
     def get_wavelengthvector(self):
-        self.debug_stream("get_wavelengthvector: size {0}".format(self.wavelengthvector_data.shape))
-        return self.wavelengthvector_data, time.time(), pt.AttrQuality.ATTR_VALID
+        return self.wavelengthvector_data, self._wv_time, pt.AttrQuality.ATTR_VALID
 
     def get_exposuretime(self):
         attr = self.dev_controller.get_attribute("exposuretime")
         return attr.value, attr.time.totime(), attr.quality
 
     def set_exposuretime(self, new_exposuretime):
-        self.debug_stream("In set_exposuretime: New value {0}".format(new_exposuretime))
-        self.debug_stream("Type dev_controller: {0}".format(type(self.dev_controller)))
+        if self.get_logger().is_debug_enabled() is True:
+            self.debug_stream("In set_exposuretime: New value {0}".format(new_exposuretime))
         self.dev_controller.write_attribute("exposuretime", new_exposuretime)
+        self._memorized["exposuretime"] = new_exposuretime
 
     def get_gain(self):
         attr = self.dev_controller.get_attribute("gain")
         return attr.value, attr.time.totime(), attr.quality
 
     def set_gain(self, new_gain):
-        self.debug_stream("In set_gain: New value {0}".format(new_gain))
+        if self.get_logger().is_debug_enabled() is True:
+            self.debug_stream("In set_gain: New value {0}".format(new_gain))
         self.dev_controller.write_attribute("gain", new_gain)
+        self._memorized["gain"] = new_gain
 
     def get_width(self):
         attr = self.dev_controller.get_attribute("width")
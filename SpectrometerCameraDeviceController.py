@@ -11,8 +11,8 @@ import PyTango.futures as ptf
 import numpy as np
 import logging
 import DeviceController as dc
-import Queue
 from CameraDeviceController_2 import CameraDeviceController
+from SpectrumKernels import reduce_spectrum, peak_and_width, frame_matches
 
 root = logging.getLogger("CameraDeviceController")
 while len(root.handlers):
@@ -31,8 +31,15 @@ class SpectrometerCameraDeviceController(CameraDeviceController):
         self.spectrum = None
         self.spectrum_width = None
         self.spectrum_peak = None
+        if wavelength_vector is not None:
+            wavelength_vector = np.ascontiguousarray(wavelength_vector, dtype=np.float64)
+            self._wl2 = wavelength_vector * wavelength_vector
+        else:
+            self._wl2 = None
         self.wavelengths = wavelength_vector
-        self.max_value = max_value
+        self.max_value = float(max_value)     # Kept as float so the kernel sees the same argument type
+        self._spec_buf = None       # float32 spectrum output, reallocated when the ROI width changes
+        self._empty_spectrum = np.empty(0, dtype=np.float32)   # Published for frames that can not be reduced
 
     def device_command_cb(self, cmd_d):
         calc_spectrum = False
@@ -47,32 +54,41 @@ class SpectrometerCameraDeviceController(CameraDeviceController):
     def calculate_spectrum(self):
         with self.lock:
             attr_image = self.attribute_dict["image"]
-            root.debug("Calculating spectrum. Type image: {0}".format(type(attr_image)))
-            if attr_image is not None:
-                quality = attr_image.quality
-                a_time = attr_image.time.totime()
-                self.spectrum = attr_image.value.sum(0)
-                self.attribute_dict["spectrum"] = (self.spectrum, a_time, quality)
-
-                try:
-                    s_bkg = self.spectrum[0:10].mean()
-                    spec_bkg = self.spectrum - s_bkg
-                    l_peak = (spec_bkg * self.wavelengths).sum() / spec_bkg.sum()
-                    dl_rms = np.sqrt((spec_bkg * (self.wavelengths - l_peak) ** 2).sum() / spec_bkg.sum())
-                    dl_fwhm = dl_rms * 2 * np.sqrt(2 * np.log(2))
-                    nbr_sat = np.double((attr_image.value >= self.max_value).sum())
-                    sat_lvl = nbr_sat / np.size(attr_image.value)
-                except AttributeError:
-                    l_peak = 0.0
-                    dl_fwhm = 0.0
-                    sat_lvl = 0.0
-                    quality = pt.AttrQuality.ATTR_INVALID
-                except ValueError:
-                    # Dimension mismatch
-                    l_peak = 0.0
-                    dl_fwhm = 0.0
-                    sat_lvl = 0.0
-                    quality = pt.AttrQuality.ATTR_INVALID
-                self.attribute_dict["width"] = (dl_fwhm, a_time, quality)
-                self.attribute_dict["peak"] = (l_peak, a_time, quality)
-                self.attribute_dict["satlvl"] = (sat_lvl, a_time, quality)
+        root.debug("Calculating spectrum. Type image: %s", type(attr_image))
+        # The reduction works on the fetched frame only, so the lock is not held while calculating.
+        # The scratch buffer is reused between frames, readers get a copy.
+        # Every call publishes a spectrum with the quality of the current frame, so get_spectrum can
+        # serve the stored entry without comparing it with the image.
+        if attr_image is None:
+            # Failed image read
+            quality = pt.AttrQuality.ATTR_INVALID
+            a_time = time.time()
+            img = None
+        else:
+            quality = attr_image.quality
+            a_time = attr_image.time.totime()
+            img = attr_image.value
+        spectrum = self._empty_spectrum
+        spectrum_quality = pt.AttrQuality.ATTR_INVALID
+        l_peak = 0.0
+        dl_fwhm = 0.0
+        sat_lvl = 0.0
+        wavelengths = self.wavelengths
+        if frame_matches(img, wavelengths) is False:
+            quality = pt.AttrQuality.ATTR_INVALID
+        else:
+            self._spec_buf, s0, s1, s2, nbr_sat = reduce_spectrum(img, wavelengths, self.max_value,
+                                                                  self._spec_buf, self._wl2)
+            spectrum = self._spec_buf.copy()
+            spectrum_quality = attr_image.quality
+            l_peak, dl_fwhm, valid = peak_and_width(s0, s1, s2)
+            if valid is False:
+                quality = pt.AttrQuality.ATTR_INVALID
+            sat_lvl = nbr_sat / float(img.size)
+        with self.lock:
+            # Always replaced, so a frame that can not be reduced does not leave an older spectrum as valid
+            self.spectrum = spectrum
+            self.attribute_dict["spectrum"] = (spectrum, a_time, spectrum_quality)
+            self.attribute_dict["width"] = (dl_fwhm, a_time, quality)
+            self.attribute_dict["peak"] = (l_peak, a_time, quality)
+            self.attribute_dict["satlvl"] = (sat_lvl, a_time, quality)
@@ -10,28 +10,26 @@ When a state transition is started, a new state object for that state is instant
 The state name to class table is stored in a dict.
 """
 
+import collections
 import threading
 import time
 import logging
 import PyTango as tango
 import numpy as np
 from twisted.internet import reactor, defer, error
+from twisted.python.failure import Failure
 import TangoTwisted
 import SpectrometerCameraController_twisted as SpectrometerCameraController
 reload(TangoTwisted)
 reload(SpectrometerCameraController)
-from TangoTwisted import TangoAttributeFactory, defer_later
+from TangoTwisted import TangoAttributeFactory, defer_later, defer_to_thread
+from SpectrumKernels import reduce_spectrum, compile_kernels, peak_and_width, frame_matches
 
 logger = logging.getLogger("SpectrometerCameraController")
-logger.setLevel(logging.DEBUG)
-while len(logger.handlers):
-    logger.removeHandler(logger.handlers[0])
 
-f = logging.Formatter("%(asctime)s - %(name)s.   %(funcName)s - %(levelname)s - %(message)s")
-fh = logging.StreamHandler()
-fh.setFormatter(f)
-logger.addHandler(fh)
-logger.setLevel(logging.DEBUG)
+# Calculated result stored in camera_result. Has the fields of DeviceAttribute that the device
+# server reads, without constructing a PyTango object per result and frame.
+SpecResult = collections.namedtuple("SpecResult", "name value time quality")
 
 
 class StateDispatcher(object):
@@ -47,33 +45,52 @@ class StateDispatcher(object):
         self.statehandler_dict[StateFault] = StateFault
         self.current_state = StateUnknown.name
         self._state_obj = None
-        self._state_thread = None
 
         self.logger = logging.getLogger("SpectrometerCameraController.SpectrometerCameraStateStateDispatcher")
         self.logger.setLevel(logging.DEBUG)
 
-    def statehandler_dispatcher(self):
+    def statehandler_dispatcher(self, prev_state=None):
+        """
+        Enter states until one is waiting for its run deferred. The dispatcher continues in
+        state_done when that deferred fires, in the thread that stopped the state.
+        States stopped before run is called are handled in this loop to avoid recursion.
+
+        :param prev_state: Name of the previous state
+        :return:
+        """
         self.logger.info("Entering state handler dispatcher")
-        prev_state = self.get_state()
         while self.stop_flag is False:
             # Determine which state object to construct:
             try:
                 state_name = self.get_state_name()
                 self.logger.debug("New state: {0}".format(state_name.upper()))
-                self._state_obj = self.statehandler_dict[state_name](self.controller)
+                state_obj = self.statehandler_dict[state_name](self.controller)
             except KeyError:
                 state_name = "unknown"
-                self.statehandler_dict[StateUnknown.name]
-            self.controller.set_state(state_name)
+                state_obj = self.statehandler_dict[StateUnknown.name](self.controller)
+            self._state_obj = state_obj
             # Do the state sequence: enter - run - exit
-            self._state_obj.state_enter(prev_state)
-            self._state_obj.run()       # <- this should be run in a loop in state object and
-            # return when it's time to change state
-            new_state = self._state_obj.state_exit()
-            # Set new state:
-            self.set_state(new_state)
+            # The state object publishes its state together with the entry status in state_enter
+            state_obj.state_enter(prev_state)
+            if state_obj.run(self.state_done, state_obj, state_name) is True:
+                return
+            self.set_state(state_obj.state_exit())
             prev_state = state_name
-        self._state_thread = None
+
+    def state_done(self, next_state, state_obj, state_name):
+        """
+        Callback for the run deferred of a state. Exit the state and continue with the next one.
+
+        :param next_state: Name of the next state, as fired by the run deferred
+        :param state_obj: State object that finished
+        :param state_name: Name of the state that finished
+        :return:
+        """
+        if state_obj is not self._state_obj:
+            # The dispatcher was restarted while this state was running
+            return
+        self.set_state(state_obj.state_exit())
+        self.statehandler_dispatcher(state_name)
 
     def get_state(self):
         return self._state_obj
@@ -95,16 +112,19 @@ class StateDispatcher(object):
         self._state_obj.check_message(msg)
 
     def stop(self):
-        self.logger.info("Stop state handler thread")
-        self._state_obj.stop_run()
+        self.logger.info("Stop state handler")
+        # Set the flag first, stopping the state may advance the dispatcher immediately
         self.stop_flag = True
+        if self._state_obj is not None:
+            self._state_obj.stop_run()
 
     def start(self):
-        self.logger.info("Start state handler thread")
-        if self._state_thread is not None:
+        self.logger.info("Start state handler")
+        if self._state_obj is not None:
             self.stop()
-        self._state_thread = threading.Thread(target=self.statehandler_dispatcher)
-        self._state_thread.start()
+            self._state_obj = None
+        self.stop_flag = False
+        self.statehandler_dispatcher()
 
 
 class State(object):
@@ -117,12 +137,18 @@ class State(object):
         self.logger.setLevel(logging.WARNING)
         self.deferred_list = list()
         self.next_state = None
-        self.cond_obj = threading.Condition()
         self.running = False
+        # Fired with next_state by stop_run. The dispatcher waits on this instead of a thread.
+        # Attaching the dispatcher callback and firing are decided under _run_lock, so that only
+        # one thread ever touches the deferred.
+        self._run_deferred = defer.Deferred()
+        self._run_lock = threading.Lock()
+        self._run_stopped = False
+        self._run_waiting = False
 
     def state_enter(self, prev_state=None):
         self.logger.info("Entering state {0}".format(self.name.upper()))
-        with self.cond_obj:
+        with self._run_lock:
             self.running = True
 
     def state_exit(self):
@@ -134,12 +160,144 @@ class State(object):
                 pass
         return self.next_state
 
-    def run(self):
+    def run(self, done_cb, *args):
+        """
+        Wait for the state to be stopped. stop_run fires the run deferred with the next state name.
+
+        :param done_cb: Callback added to the run deferred, called with the next state name and args
+        :param args: Extra arguments for done_cb
+        :return: True if waiting, False if the state was already stopped. done_cb is then not called.
+        """
         self.logger.info("Entering run, run condition {0}".format(self.running))
-        with self.cond_obj:
-            if self.running is True:
-                self.cond_obj.wait()
-        self.logger.debug("Exiting run")
+        with self._run_lock:
+            if self._run_stopped is True:
+                return False
+            self._run_deferred.addCallback(done_cb, *args)
+            self._run_waiting = True
+        return True
+
+    def start_looping_call(self, attr_name, interval, dev_name="camera"):
+        """
+        Start polling an attribute with a looping call. Results are sent to update_attribute.
+
+        :param attr_name: Tango name of the attribute
+        :param interval: Polling period in s
+        :param dev_name: Name of the device in the controller device_names dict
+        :return: The started LoopingCall
+        """
+        self.logger.debug("Starting looping call for {0}".format(attr_name))
+        lc = TangoTwisted.LoopingCall.withCount(lambda count: self.controller.read_attribute(attr_name, dev_name))
+        self.controller.looping_calls.append(lc)
+        d = lc.start(interval)
+        d.addCallbacks(self.update_attribute, self.state_error)
+        lc.loop_deferred.addCallback(self.update_attribute)
+        lc.loop_deferred.addErrback(self.state_error)
+        return lc
+
+    def start_looping_calls(self, attr_params, dev_name="camera"):
+        """
+        Start polling the attributes in attr_params. Attributes with the same polling period
+        share one looping call that reads them in a single Tango request.
+
+        :param attr_params: Dict of attribute name: polling period in s
+        :param dev_name: Name of the device in the controller device_names dict
+        :return:
+        """
+        interval_dict = dict()
+        for key, interval in attr_params.items():
+            interval_dict.setdefault(interval, list()).append(key)
+        for interval, names in interval_dict.items():
+            if len(names) == 1:
+                self.start_looping_call(names[0], interval, dev_name)
+            else:
+                self.start_bulk_looping_call(names, interval, dev_name)
+
+    def start_bulk_looping_call(self, attr_names, interval, dev_name="camera"):
+        """
+        Start polling several attributes with one looping call. Results are sent to update_attributes.
+
+        :param attr_names: List of Tango attribute names
+        :param interval: Polling period in s
+        :param dev_name: Name of the device in the controller device_names dict
+        :return: The started LoopingCall
+        """
+        self.logger.debug("Starting looping call for {0}".format(", ".join(attr_names)))
+        lc = TangoTwisted.LoopingCall.withCount(lambda count: self.controller.read_attributes(attr_names, dev_name))
+        self.controller.looping_calls.append(lc)
+        d = lc.start(interval)
+        # The start deferred fires with the looping call itself when stopped, so it only gets the errback
+        d.addErrback(self.state_error)
+        lc.loop_deferred.addCallback(self.update_attributes)
+        lc.loop_deferred.addErrback(self.state_error)
+        return lc
+
+    def start_event_subscriptions(self, dev_name="camera"):
+        """
+        Subscribe to change events for the attributes in controller.event_attr_params.
+        If the subscription fails the attribute is polled instead. The polling is started when all
+        subscriptions are done, so that failed attributes with the same period share a looping call.
+
+        :param dev_name: Name of the device in the controller device_names dict
+        :return:
+        """
+        dl = list()
+        for key, interval in self.controller.event_attr_params.items():
+            self.logger.debug("Subscribing to change events for {0}".format(key))
+            d = self.controller.subscribe_event(key, dev_name, self.update_attribute, self.is_running)
+            # Fires with None when subscribed, or with the (name, period) to poll when not
+            d.addCallbacks(lambda event_id: None, self.event_subscription_error, errbackArgs=[key, interval])
+            dl.append(d)
+        d = defer.gatherResults(dl)
+        d.addCallback(self.start_fallback_polling, dev_name)
+        d.addErrback(self.state_error)
+
+    def is_running(self):
+        return self.running
+
+    def event_subscription_error(self, err, attr_name, interval):
+        self.logger.warning("Change events not available for {0}, polling instead. {1}".format(attr_name, err))
+        return attr_name, interval
+
+    def start_fallback_polling(self, results, dev_name):
+        """
+        Poll the attributes whose change event subscription failed.
+
+        :param results: List with None for subscribed attributes and (name, period) for the others
+        :param dev_name: Name of the device in the controller device_names dict
+        :return:
+        """
+        attr_params = dict([r for r in results if r is not None])
+        if self.running is True and len(attr_params) > 0:
+            self.start_looping_calls(attr_params, dev_name)
+        return results
+
+    def stop_looping_calls(self):
+        """
+        Stop the looping calls and event subscriptions started by the state.
+        The list is swapped out first, so looping calls started by callbacks meanwhile go to the new list.
+
+        :return:
+        """
+        looping_calls, self.controller.looping_calls = self.controller.looping_calls, list()
+        for lc in looping_calls:
+            # Stop looping calls (ignore callback). A looping call that failed has already stopped.
+            if lc.running is True:
+                try:
+                    lc.stop()
+                except Exception as e:
+                    self.logger.error("Could not stop looping call: {0}".format(e))
+        self.controller.unsubscribe_events()
+
+    def update_attribute(self, result):
+        pass
+
+    def update_attributes(self, results):
+        # LoopingCall.withCount delivers None when the timer fires before the next interval starts
+        if results is None:
+            return results
+        for result in results:
+            self.update_attribute(result)
+        return results
 
     def check_requirements(self, result):
         """
@@ -151,8 +309,7 @@ class State(object):
 
     def check_message(self, msg):
         """
-        Check message with condition object released and take appropriate action.
-        The condition object is released already in the send_message function.
+        Check message and take appropriate action.
 
         -- This could be a message queue if needed...
 
@@ -172,16 +329,24 @@ class State(object):
 
     def send_message(self, msg):
         self.logger.info("Message {0} received".format(msg))
-        with self.cond_obj:
-            self.cond_obj.notify_all()
-            self.check_message(msg)
+        self.check_message(msg)
 
     def stop_run(self):
-        self.logger.info("Notify condition to stop run")
-        with self.cond_obj:
+        self.logger.info("Fire run deferred to stop run")
+        with self._run_lock:
             self.running = False
-            self.logger.debug("Run condition {0}".format(self.running))
-            self.cond_obj.notify_all()
+            if self._run_stopped is True:
+                return
+            self._run_stopped = True
+            waiting = self._run_waiting
+        if waiting is False:
+            # Stopped before run, the dispatcher sees that and continues with the next state itself
+            return
+        # Fire outside the lock, the dispatcher continues with the next state in this call
+        if reactor.running is True:
+            reactor.callFromThread(self._run_deferred.callback, self.next_state)
+        else:
+            self._run_deferred.callback(self.next_state)
 
 
 class StateDeviceConnect(State):
@@ -190,30 +355,41 @@ class StateDeviceConnect(State):
     The names of the devices are stored in the controller.device_names list.
     Devices are stored as TangoAttributeFactories in controller.device_factory_dict
 
+    Factories from an earlier connection are reused if their device name is unchanged, so a
+    reconnect after a transient error does not create new deviceproxies.
+
     """
     name = "device_connect"
 
     def __init__(self, controller):
         State.__init__(self, controller)
-        self.controller.device_factory_dict = dict()
         self.deferred_list = list()
 
     def state_enter(self, prev_state):
         State.state_enter(self, prev_state)
-        self.controller.set_status("Connecting to devices.")
+        self.controller.set_state_and_status(self.name, "Connecting to devices.")
+        old_factory_dict = self.controller.device_factory_dict
+        # Factories for devices no longer in device_names are dropped here
+        self.controller.clear_device_factories()
         dl = list()
         for key, dev_name in self.controller.device_names.items():
-            self.logger.debug("Connect to device {0}".format(dev_name))
-            fact = TangoAttributeFactory(dev_name)
-            dl.append(fact.startFactory())
-            self.controller.device_factory_dict[dev_name] = fact
+            fact = old_factory_dict.get(dev_name)
+            if fact is None:
+                self.logger.debug("Connect to device {0}".format(dev_name))
+                fact = TangoAttributeFactory(dev_name)
+                dl.append(fact.startFactory())
+            else:
+                self.logger.debug("Reuse connection to device {0}".format(dev_name))
+                dl.append(fact.resume())
+            self.controller.set_device_factory(key, fact)
         self.logger.debug("List of deferred device proxys: {0}".format(dl))
-        def_list = defer.DeferredList(dl)
+        # Fires with the list of connected devices, or fails with the first connection error
+        def_list = defer.gatherResults(dl, consumeErrors=True)
         self.deferred_list.append(def_list)
         def_list.addCallbacks(self.check_requirements, self.state_error)
 
     def check_requirements(self, result):
-        self.logger.info("Check requirements result: {0}".format(result))
+        self.logger.info("Check requirements: {0} devices connected".format(len(result)))
         self.next_state = "setup_attributes"
         self.stop_run()
         return "setup_attributes"
@@ -246,7 +422,7 @@ class StateSetupAttributes(State):
 
     def state_enter(self, prev_state=None):
         State.state_enter(self, prev_state)
-        self.controller.set_status("Setting up device parameters.")
+        self.controller.set_state_and_status(self.name, "Setting up device parameters.")
         self.logger.debug("Stopping camera before setting attributes")
         dl = list()
         d1 = self.controller.send_command("stop", "camera", None)
@@ -255,7 +431,7 @@ class StateSetupAttributes(State):
         dl.append(d1)
         dl.append(d2)
 
-        d = defer.DeferredList(dl)
+        d = defer.gatherResults(dl, consumeErrors=True)
         d.addCallbacks(self.setup_attr, self.state_error)
         self.deferred_list.append(d)
 
@@ -263,9 +439,9 @@ class StateSetupAttributes(State):
         self.logger.info("Entering setup_attr")
         # Go through all the attributes in the setup_attr_params dict and add
         # do check_attribute with write to each.
-        # The deferreds are collected in a list that is added to a DeferredList
-        # When the DeferredList fires, the check_requirements method is called
-        # as a callback.
+        # The deferreds are collected in a list that is gathered into one deferred.
+        # When all have fired, the check_requirements method is called as a callback.
+        # A failed attribute fails the gathered deferred and state_error is called instead.
         dl = list()
         for key in self.controller.setup_params:
             attr_name = key
@@ -285,14 +461,13 @@ class StateSetupAttributes(State):
             d.addCallbacks(self.attr_check_cb, self.attr_check_eb)
             dl.append(d)
 
-        # Create DeferredList that will fire when all the attributes are done:
-        def_list = defer.DeferredList(dl)
+        # Gather the deferreds into one that will fire when all the attributes are done:
+        def_list = defer.gatherResults(dl, consumeErrors=True)
         self.deferred_list.append(def_list)
         def_list.addCallbacks(self.check_requirements, self.state_error)
 
     def check_requirements(self, result):
-        self.logger.info("Check requirements")
-        # self.logger.info("Check requirements result: {0}".format(result))
+        self.logger.info("Check requirements: {0} attributes set up".format(len(result)))
         self.next_state = "running"
         self.stop_run()
         return result
@@ -306,49 +481,50 @@ class StateSetupAttributes(State):
 
     def attr_check_cb(self, result):
         self.logger.info("Check attribute result: {0}".format(result))
-        self.controller.camera_result[result.name.lower()] = result
+        self.controller.store_results({result.name.lower(): result})
         return result
 
     def attr_check_eb(self, err):
-        self.logger.error("Check attribute ERROR: {0}".format(error))
+        self.logger.error("Check attribute ERROR: {0}".format(err))
         return err
 
 
-class StateRunning(State):
+class StateActive(State):
     """
-    Wait for time for a new scan or a command. Parameters stored in controller.idle_params
-    idle_params["scan_interval"]: time in seconds between scans
+    Common part of the running and on states. The camera command sent when entering, the polled
+    attributes and the messages handled are set as class attributes by the subclasses.
+    Attributes in controller.event_attr_params are monitored with change events in both.
     """
-    name = "running"
+    name = ""
+    camera_command = None           # Command sent to the camera in state_enter
+    enter_status = ""               # Status while the camera command is running
+    done_status = ""                # Status when the camera command is done
+    attr_params_name = None         # Name of the controller dict with attribute name: polling period
+    message_states = dict()         # Message: next state
 
     def __init__(self, controller):
         State.__init__(self, controller)
         self.t0 = time.time()
-        self.logger.setLevel(logging.WARNING)
 
     def state_enter(self, prev_state=None):
         State.state_enter(self, prev_state)
-        # Start camera:
-        self.controller.set_status("Starting spectrometer camera")
-        d = self.controller.send_command("start", "camera", None)
+        self.controller.set_state_and_status(self.name, self.enter_status)
+        d = self.controller.send_command(self.camera_command, "camera", None)
         d.addCallbacks(self.check_requirements, self.state_error)
         self.deferred_list.append(d)
-        # Start looping calls for monitored attributes
-        dev_name = "camera"
+        # Start looping calls for polled attributes and subscribe to events for the rest
+        self.stop_looping_calls()
+        self.start_looping_calls(getattr(self.controller, self.attr_params_name))
+        self.start_event_subscriptions()
+
+    def state_exit(self):
+        # running is already False here, so subscriptions completing later are dropped by the controller
         self.stop_looping_calls()
-        for key in self.controller.running_attr_params:
-            self.logger.debug("Starting looping call for {0}".format(key))
-            interval = self.controller.running_attr_params[key]
-            lc = TangoTwisted.LoopingCall(self.controller.read_attribute, key, dev_name)
-            self.controller.looping_calls.append(lc)
-            d = lc.start(interval)
-            d.addCallbacks(self.update_attribute, self.state_error)
-            lc.loop_deferred.addCallback(self.update_attribute)
-            lc.loop_deferred.addErrback(self.state_error)
+        return State.state_exit(self)
 
     def check_requirements(self, result):
         self.logger.info("Check requirements result: {0}".format(result))
-        self.controller.set_status("Spectrometer running")
+        self.controller.set_status(self.done_status)
         return True
 
     def state_error(self, err):
@@ -364,169 +540,189 @@ class StateRunning(State):
                 self.stop_run()
 
     def check_message(self, msg):
-        if msg == "stop":
-            self.logger.debug("Message stop... set next state.")
+        next_state = self.message_states.get(msg)
+        if next_state is not None:
+            self.logger.debug("Message {0}... set next state.".format(msg))
             for d in self.deferred_list:
                 d.cancel()
             self.stop_looping_calls()
-            self.next_state = "on"
+            self.next_state = next_state
             self.stop_run()
 
-    def stop_looping_calls(self):
-        for lc in self.controller.looping_calls:
-            # Stop looping calls (ignore callback):
-            try:
-                lc.stop()
-            except Exception as e:
-                self.logger.error("Could not stop looping call: {0}".format(e))
-        self.controller.looping_calls = list()
-
     def update_attribute(self, result):
         self.logger.info("Updating result")
         try:
-            self.logger.debug("Result for {0}: {1}".format(result.name, result.value))
+            self.logger.debug("Result for %s: %s", result.name, result.value)
         except AttributeError:
             return
-        with self.controller.state_lock:
-            self.controller.camera_result[result.name.lower()] = result
-        if result.name.lower() == "image":
-            self.calculate_spectrum(result)
-
-    def calculate_spectrum(self, result):
-        attr_image = result
-        self.logger.debug("Calculating spectrum. Type image: {0}".format(type(attr_image)))
-        with self.controller.state_lock:
-            wavelengths = self.controller.camera_result["wavelengths"].value
-            max_value = self.controller.camera_result["max_value"].value
-        if attr_image is not None:
-            quality = attr_image.quality
-            a_time = attr_image.time
-            spectrum = attr_image.value.sum(0)
+        self.controller.store_results({result.name.lower(): result})
 
-            try:
-                s_bkg = spectrum[0:10].mean()
-                spec_bkg = spectrum - s_bkg
-                l_peak = (spec_bkg * wavelengths).sum() / spec_bkg.sum()
-                try:
-                    dl_rms = np.sqrt((spec_bkg * (wavelengths - l_peak) ** 2).sum() / spec_bkg.sum())
-                    dl_fwhm = dl_rms * 2 * np.sqrt(2 * np.log(2))
-                except RuntimeWarning:
-                    dl_rms = None
-                    dl_fwhm = None
-                nbr_sat = np.double((attr_image.value >= max_value).sum())
-                sat_lvl = nbr_sat / np.size(attr_image.value)
-            except AttributeError:
-                l_peak = 0.0
-                dl_fwhm = 0.0
-                sat_lvl = 0.0
-                quality = tango.AttrQuality.ATTR_INVALID
-            except ValueError:
-                # Dimension mismatch
-                l_peak = 0.0
-                dl_fwhm = 0.0
-                sat_lvl = 0.0
-                quality = tango.AttrQuality.ATTR_INVALID
-            self.logger.debug("Spectrum parameters calculated")
-            attr = tango.DeviceAttribute()
-            attr.name = "spectrum"
-            attr.value = spectrum
-            attr.time = a_time
-            attr.quality = quality
-            self.controller.camera_result["spectrum"] = attr
-            attr = tango.DeviceAttribute()
-            attr.name = "width"
-            attr.value = dl_fwhm
-            attr.time = a_time
-            attr.quality = quality
-            self.controller.camera_result["width"] = attr
-            attr = tango.DeviceAttribute()
-            attr.name = "peak"
-            attr.value = l_peak
-            attr.time = a_time
-            attr.quality = quality
-            self.controller.camera_result["peak"] = attr
-            attr = tango.DeviceAttribute()
-            attr.name = "satlvl"
-            attr.value = sat_lvl
-            attr.time = a_time
-            attr.quality = quality
-            self.controller.camera_result["satlvl"] = attr
-
-
-class StateOn(State):
+
+class StateRunning(StateActive):
     """
-    Wait for time for a new scan or a command. Parameters stored in controller.idle_params
-    idle_params["scan_interval"]: time in seconds between scans
+    Camera acquiring. The image is polled with the periods in controller.running_attr_params
+    and a spectrum is calculated for each new frame.
     """
-    name = "on"
+    name = "running"
+    camera_command = "start"
+    enter_status = "Starting spectrometer camera"
+    done_status = "Spectrometer running"
+    attr_params_name = "running_attr_params"
+    message_states = {"stop": "on"}
 
     def __init__(self, controller):
-        State.__init__(self, controller)
-        self.t0 = time.time()
+        StateActive.__init__(self, controller)
+        self._wl = None             # Wavelength vector and saturation level, snapshot in state_enter
+        self._wl2 = None
+        self._max_value = np.inf
+        self._empty_spectrum = np.empty(0, dtype=np.float32)
+        self._spec_buf = None       # Column sum scratch buffer, reused while the image width is unchanged
+        self._last_image_time = None
+        self._image_generation = None
+        self.logger.setLevel(logging.WARNING)
 
     def state_enter(self, prev_state=None):
-        State.state_enter(self, prev_state)
-        # d = defer.Deferred()
-        self.controller.set_status("Stopping spectrometer camera")
-        d = self.controller.send_command("stop", "camera", None)
-        d.addCallbacks(self.check_requirements, self.state_error)
-        self.deferred_list.append(d)
-
-        dev_name = "camera"
-        self.stop_looping_calls()
-        for key in self.controller.standby_attr_params:
-            self.logger.debug("Starting looping call for {0}".format(key))
-            interval = self.controller.standby_attr_params[key]
-            lc = TangoTwisted.LoopingCall(self.controller.read_attribute, key, dev_name)
-            self.controller.looping_calls.append(lc)
-            d = lc.start(interval)
-            d.addCallbacks(self.update_attribute, self.state_error)
-            lc.loop_deferred.addCallback(self.update_attribute)
-            lc.loop_deferred.addErrback(self.state_error)
+        self.snapshot_spectrometer()
+        # One worker thread calculates the spectra for the whole time the state runs
+        self._image_generation = self.controller.start_image_processing()
+        worker = threading.Thread(target=self.process_images, args=(self._image_generation, ),
+                                  name="SpectrumWorker")
+        worker.daemon = True
+        worker.start()
+        # Compile the spectrum kernels in a worker instead of when the first frame arrives
+        image_attr = self.controller.get_attribute("image")
+        try:
+            image_dtype = image_attr.value.dtype
+        except AttributeError:
+            image_dtype = np.uint16
+        d = defer_to_thread(compile_kernels, image_dtype, self._wl, self._wl2)
+        d.addErrback(lambda err: self.logger.warning("Could not compile spectrum kernels: {0}".format(err)))
+        StateActive.state_enter(self, prev_state)
 
-    def check_requirements(self, result):
-        self.logger.info("Check requirements result: {0}".format(result))
-        self.controller.set_status("Spectrometer standby")
-        return True
+    def snapshot_spectrometer(self):
+        """
+        Copy the wavelength vector and saturation level set up by the device server, so that the
+        spectrum calculation does not look them up for every frame. The device server only sets them up
+        before the state machine is started. Call again if they are changed while running.
 
-    def state_error(self, err):
-        self.logger.error("Error: {0}".format(err))
-        if err.type == defer.CancelledError:
-            self.logger.info("Cancelled error, ignore")
+        :return:
+        """
+        camera_result = self.controller.camera_result
+        wavelength_attr = camera_result.get("wavelengths")
+        max_value_attr = camera_result.get("max_value")
+        if wavelength_attr is not None and wavelength_attr.value is not None:
+            self._wl = wavelength_attr.value
+            self._wl2 = self._wl * self._wl
         else:
-            self.controller.set_status("Error: {0}".format(err))
-            self.stop_looping_calls()
-            # If the error was DB_DeviceNotDefined, go to UNKNOWN state and reconnect later
-            self.next_state = "unknown"
-            self.stop_run()
+            self._wl = None
+            self._wl2 = None
+        if max_value_attr is not None and max_value_attr.value is not None:
+            self._max_value = float(max_value_attr.value)
+        else:
+            self._max_value = np.inf
 
-    def stop_looping_calls(self):
-        for lc in self.controller.looping_calls:
-            # Stop looping calls (ignore callback):
+    def update_attribute(self, result):
+        StateActive.update_attribute(self, result)
+        if getattr(result, "name", "").lower() == "image":
+            # Polling faster than the camera frame rate returns the same frame again, skip it
             try:
-                lc.stop()
-            except Exception as e:
-                self.logger.error("Could not stop looping call: {0}".format(e))
-        self.controller.looping_calls = list()
+                image_time = result.time.totime()
+            except AttributeError:
+                image_time = None
+            if image_time is not None and image_time == self._last_image_time:
+                return
+            self._last_image_time = image_time
+            self.controller.put_image(result)
 
-    def check_message(self, msg):
-        if msg == "start":
-            self.logger.debug("Message start... set next state.")
-            for d in self.deferred_list:
-                d.cancel()
-            self.stop_looping_calls()
+    def state_exit(self):
+        # Flag the worker off instead of joining, state_exit may run in the worker thread after an error
+        self.controller.stop_image_processing()
+        return StateActive.state_exit(self)
 
-            self.next_state = "running"
-            self.stop_run()
+    def process_images(self, generation):
+        """
+        Calculate spectra for the images put in the controller image slot until the image processing
+        generation is stopped. Runs in the worker thread started in state_enter, so the thread
+        delivering the images is not blocked by the calculation.
 
-    def update_attribute(self, result):
-        self.logger.info("Updating result")
-        try:
-            self.logger.debug("Result for {0}: {1}".format(result.name, result.value))
-        except AttributeError:
-            return
-        with self.controller.state_lock:
-            self.controller.camera_result[result.name.lower()] = result
+        :param generation: Image processing generation from controller.start_image_processing
+        :return:
+        """
+        image = self.controller.take_image(generation)
+        while image is not None:
+            try:
+                self.store_spectrum_results(self.compute_spectrum(image))
+            except Exception:
+                self.state_error(Failure())
+                return
+            image = self.controller.take_image(generation)
+
+    def compute_spectrum(self, attr_image):
+        """
+        Calculate spectrum, width, peak and saturation level for a camera image. Only state
+        owned buffers are used, the controller is not accessed.
+
+        :param attr_image: DeviceAttribute with the camera image
+        :return: Tuple (spectrum, width, peak, satlvl, time, quality, spectrum quality). The spectrum
+        keeps the image quality when only the peak is missing.
+        """
+        self.logger.debug("Calculating spectrum. Type image: %s", type(attr_image))
+        quality = attr_image.quality
+        a_time = attr_image.time
+        img = attr_image.value
+        if frame_matches(img, self._wl) is False:
+            return self._invalid_results(a_time)
+        # Spectrum, saturation count and moments in one pass over the image
+        self._spec_buf, s0, s1, s2, nbr_sat = reduce_spectrum(img, self._wl, self._max_value,
+                                                              self._spec_buf, self._wl2)
+        spectrum_quality = quality
+        l_peak, dl_fwhm, valid = peak_and_width(s0, s1, s2)
+        if valid is False:
+            quality = tango.AttrQuality.ATTR_INVALID
+        sat_lvl = nbr_sat / float(img.size)
+        # The published spectrum may still be read when the next frame is summed
+        spectrum = self._spec_buf.copy()
+        self.logger.debug("Spectrum parameters calculated")
+        return spectrum, dl_fwhm, l_peak, sat_lvl, a_time, quality, spectrum_quality
+
+    def _invalid_results(self, a_time):
+        """
+        Results for a frame that can not be reduced: no image, no wavelength vector or an image
+        width that does not match the wavelength vector.
+
+        :param a_time: Time of the camera image
+        :return: Tuple (spectrum, width, peak, satlvl, time, quality, spectrum quality) like compute_spectrum
+        """
+        invalid = tango.AttrQuality.ATTR_INVALID
+        return self._empty_spectrum, 0.0, 0.0, 0.0, a_time, invalid, invalid
+
+    def store_spectrum_results(self, results):
+        """
+        Store the results of compute_spectrum in the controller camera_result dict.
+
+        :param results: Tuple (spectrum, width, peak, satlvl, time, quality, spectrum quality)
+        :return:
+        """
+        spectrum, dl_fwhm, l_peak, sat_lvl, a_time, quality, spectrum_quality = results
+        spectrum_attr = SpecResult("spectrum", spectrum, a_time, spectrum_quality)
+        width_attr = SpecResult("width", dl_fwhm, a_time, quality)
+        peak_attr = SpecResult("peak", l_peak, a_time, quality)
+        satlvl_attr = SpecResult("satlvl", sat_lvl, a_time, quality)
+        # Published together, so a reader never mixes spectrum and peak from different frames
+        self.controller.store_results({"spectrum": spectrum_attr, "width": width_attr,
+                                       "peak": peak_attr, "satlvl": satlvl_attr})
+
+
+class StateOn(StateActive):
+    """
+    Camera stopped. Attributes in controller.standby_attr_params are polled.
+    """
+    name = "on"
+    camera_command = "stop"
+    enter_status = "Stopping spectrometer camera"
+    done_status = "Spectrometer standby"
+    attr_params_name = "standby_attr_params"
+    message_states = {"start": "running"}
 
 
 class StateFault(State):
@@ -538,6 +734,11 @@ class StateFault(State):
     def __init__(self, controller):
         State.__init__(self, controller)
 
+    def state_enter(self, prev_state=None):
+        State.state_enter(self, prev_state)
+        # Keep the status set by the previous state, it holds the reason for the fault
+        self.controller.set_state_and_status(self.name, self.controller.get_status())
+
 
 class StateUnknown(State):
     """
@@ -554,7 +755,8 @@ class StateUnknown(State):
 
     def state_enter(self, prev_state):
         self.logger.info("Starting state {0}".format(self.name.upper()))
-        self.controller.set_status("Waiting {0} s before trying to reconnect".format(self.wait_time))
+        self.controller.set_state_and_status(self.name,
+                                             "Waiting {0} s before trying to reconnect".format(self.wait_time))
         self.start_time = time.time()
         df = defer_later(self.wait_time, self.check_requirements, [None])
         self.deferred_list.append(df)
@@ -576,7 +778,14 @@ def test_err(err):
 
 
 if __name__ == "__main__":
+    SpectrometerCameraController.configure_logging()
     fc = SpectrometerCameraController.SpectrometerCameraController("gunlaser/cameras/spectrometer_camera")
 
     sh = StateDispatcher(fc)
     sh.start()
+    # The dispatcher has no thread of its own, keep the process alive while the states run
+    try:
+        while True:
+            time.sleep(1.0)
+    except KeyboardInterrupt:
+        sh.stop()
@@ -0,0 +1,237 @@
+# -*- coding:utf-8 -*-
+"""
+Created on Oct 15, 2026
+
+@author: Filip Lindau
+
+Reduction kernels for calculating spectra from camera images.
+Numba is used when it is installed, otherwise the kernels fall back to numpy.
+Numba compiles one specialization per image dtype on first use and caches it on disk,
+so a camera delivering uint8 or uint16 frames runs a kernel built for that width.
+"""
+import math
+import numpy as np
+
+try:
+    from numba import njit, prange
+    numba_available = True
+except ImportError:
+    numba_available = False
+
+# Columns handled per parallel block. Each block reads contiguous row segments of the image.
+_BLOCK = 64
+
+# Number of columns at the start of the spectrum used for the background level
+_BKG_COLUMNS = 10
+
+# Ratio of FWHM to rms width of a Gaussian, converts the width from the second moment to FWHM
+FWHM_COEF = 2.0 * math.sqrt(2.0 * math.log(2.0))
+
+
+if numba_available is True:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _col_sum(img, acc_dtype, out):
+        h, w = img.shape
+        n_blocks = (w + _BLOCK - 1) // _BLOCK
+        for b in prange(n_blocks):
+            j0 = b * _BLOCK
+            j1 = min(j0 + _BLOCK, w)
+            # Accumulate exactly in acc_dtype, only the stored spectrum is float32
+            acc = np.zeros(j1 - j0, dtype=acc_dtype)
+            for i in range(h):
+                for j in range(j0, j1):
+                    acc[j - j0] += img[i, j]
+            for j in range(j0, j1):
+                out[j] = acc[j - j0]
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _reduce(img, acc_dtype, wl, wl2, max_value, col_sum, out_scalars):
+        h, w = img.shape
+        sat = np.zeros(w, dtype=np.int64)
+        n_blocks = (w + _BLOCK - 1) // _BLOCK
+        for b in prange(n_blocks):
+            j0 = b * _BLOCK
+            j1 = min(j0 + _BLOCK, w)
+            acc = np.zeros(j1 - j0, dtype=acc_dtype)
+            sat_acc = np.zeros(j1 - j0, dtype=np.int64)
+            for i in range(h):
+                for j in range(j0, j1):
+                    v = img[i, j]
+                    acc[j - j0] += v
+                    # Branchless so the inner loop vectorizes
+                    sat_acc[j - j0] += v >= max_value
+            for j in range(j0, j1):
+                col_sum[j] = acc[j - j0]
+                sat[j] = sat_acc[j - j0]
+        n_bkg = min(_BKG_COLUMNS, w)
+        bkg = 0.0
+        for j in range(n_bkg):
+            bkg += col_sum[j]
+        bkg /= n_bkg
+        # The moments are accumulated in float64, s2 / s0 - peak**2 cancels most significant digits
+        s0 = 0.0
+        s1 = 0.0
+        s2 = 0.0
+        n_sat = 0
+        for j in range(w):
+            c = np.float64(col_sum[j]) - bkg
+            s0 += c
+            s1 += c * wl[j]
+            s2 += c * wl2[j]
+            n_sat += sat[j]
+        out_scalars[0] = s0
+        out_scalars[1] = s1
+        out_scalars[2] = s2
+        out_scalars[3] = n_sat
+
+
+def wavelength_vector(central_wavelength, dispersion, n_points):
+    """
+    Calculate the wavelength of each camera column. The central wavelength is at column n_points / 2.
+
+    :param central_wavelength: Wavelength at the center of the ROI in nm
+    :param dispersion: Wavelength step per column in nm
+    :param n_points: Number of columns
+    :return: Read-only C-contiguous float64 vector with the wavelengths in m
+    """
+    n_points = int(n_points)
+    # Scale the end points instead of the array so linspace produces the final vector in one pass
+    start = (central_wavelength - n_points / 2.0 * dispersion) * 1e-9
+    stop = (central_wavelength + (n_points / 2.0 - 1) * dispersion) * 1e-9
+    wl = np.linspace(start, stop, n_points, dtype=np.float64)
+    wl.flags.writeable = False
+    return wl
+
+
+def _acc_dtype(img):
+    """
+    Accumulator type for the column sums. Integer frames are summed in int64, which is exact
+    and lets the compiler use packed integer adds. Other frames are summed in float64.
+    """
+    if np.issubdtype(img.dtype, np.integer):
+        return np.int64
+    return np.float64
+
+
+def _saturation_threshold(img, max_value):
+    """
+    Saturation level as an integer for integer frames, so pixels are compared without converting
+    them to float. v >= max_value is the same as v >= ceil(max_value) for integer v. Levels above
+    the range of the dtype are clamped to one past the maximum, so no pixel counts as saturated.
+    """
+    if not np.issubdtype(img.dtype, np.integer):
+        return float(max_value)
+    info = np.iinfo(img.dtype)
+    if max_value > info.max:
+        return np.int64(info.max) + 1
+    if max_value <= info.min:
+        return np.int64(info.min)
+    return np.int64(np.ceil(max_value))
+
+
+def frame_matches(img, wl):
+    """
+    Check that a frame can be reduced with a wavelength vector. Callers check this before
+    reduce_spectrum, so frames from a changed ROI are not summed only to be discarded.
+
+    :param img: 2D image array or None
+    :param wl: Wavelength vector or None
+    :return: True if there is a 2D image with one column per wavelength
+    """
+    return img is not None and wl is not None and img.ndim == 2 and img.shape[1] == wl.shape[0]
+
+
+def column_sum(img, out=None):
+    """
+    Sum the columns of a 2D image into a float32 vector.
+
+    :param img: 2D image array
+    :param out: Optional preallocated float32 output vector. A new vector is allocated if it is None,
+    does not match the image width or is not contiguous.
+    :return: C-contiguous vector with the column sums, so it can be handed to Tango without a copy
+    """
+    img = np.ascontiguousarray(img)
+    if out is None or out.shape[0] != img.shape[1] or out.flags.c_contiguous is False:
+        out = np.empty(img.shape[1], dtype=np.float32)
+    if numba_available is True:
+        _col_sum(img, _acc_dtype(img), out)
+    else:
+        np.add.reduce(img, axis=0, dtype=np.float32, out=out)
+    return out
+
+
+def reduce_spectrum(img, wl, max_value, out=None, wl2=None):
+    """
+    Calculate the spectrum of a 2D image together with the moments needed for peak and width,
+    streaming the image once when numba is available.
+    The background level is the mean of the first columns of the spectrum.
+
+    :param img: 2D image array
+    :param wl: Wavelength vector, float64 with one element per image column
+    :param max_value: Pixel value counted as saturated
+    :param out: Optional preallocated float32 output vector for the spectrum, replaced if not contiguous
+    :param wl2: Optional precomputed wl * wl, computed here if None
+    :return: Tuple (spectrum, s0, s1, s2, n_sat) where s0, s1, s2 are the sums of the background
+    subtracted spectrum weighted by 1, wl, and wl**2, and n_sat is the number of saturated pixels.
+    The sums are plain Python floats and n_sat an int, so the per-frame arithmetic on them stays
+    out of numpy scalar code.
+    """
+    img = np.ascontiguousarray(img)
+    if wl.shape[0] != img.shape[1]:
+        raise ValueError("Dimension mismatch: {0} wavelengths for {1} columns".format(wl.shape[0], img.shape[1]))
+    if out is None or out.shape[0] != img.shape[1] or out.flags.c_contiguous is False:
+        out = np.empty(img.shape[1], dtype=np.float32)
+    if wl2 is None:
+        wl2 = wl * wl
+    max_value = _saturation_threshold(img, max_value)
+    if numba_available is True:
+        scalars = np.empty(4, dtype=np.float64)
+        _reduce(img, _acc_dtype(img), wl, wl2, max_value, out, scalars)
+        s0, s1, s2, n_sat = scalars.tolist()
+        return out, s0, s1, s2, int(n_sat)
+    np.add.reduce(img, axis=0, dtype=np.float32, out=out)
+    # Comparing in the native dtype and counting is faster than a numexpr sum(where(...)), which widens
+    # uint16 to int32 and reduces in a single thread. The moments are short dot products.
+    if np.issubdtype(img.dtype, np.integer) is False:
+        n_sat = np.count_nonzero(img >= max_value)
+    elif max_value > np.iinfo(img.dtype).max:
+        n_sat = 0
+    else:
+        n_sat = np.count_nonzero(img >= img.dtype.type(max_value))
+    spec_bkg = out.astype(np.float64)
+    spec_bkg -= spec_bkg[0:_BKG_COLUMNS].mean()
+    return out, float(spec_bkg.sum()), float(spec_bkg.dot(wl)), float(spec_bkg.dot(wl2)), int(n_sat)
+
+
+def peak_and_width(s0, s1, s2):
+    """
+    Calculate the peak and the FWHM width of a spectrum from the moments returned by reduce_spectrum.
+    A frame at or below the background has no peak. The check on s0 is also False for nan.
+
+    :param s0: Sum of the background subtracted spectrum
+    :param s1: Sum weighted by wavelength
+    :param s2: Sum weighted by wavelength squared
+    :return: Tuple (peak, fwhm, valid). Peak and fwhm are 0 and valid is False if there is no peak.
+    """
+    if s0 > 0.0:
+        peak = s1 / s0
+        fwhm = math.sqrt(max(0.0, s2 / s0 - peak * peak)) * FWHM_COEF
+        return peak, fwhm, True
+    return 0.0, 0.0, False
+
+
+def compile_kernels(dtype, wl, wl2=None):
+    """
+    Compile the kernels for frames of the given dtype ahead of the first frame by reducing a
+    one row frame. Numba caches the compiled kernels on disk, so this is only slow on the first run.
+
+    :param dtype: Pixel dtype of the camera frames
+    :param wl: Wavelength vector that will be used for the frames
+    :param wl2: Optional precomputed wl * wl that will be used for the frames
+    :return:
+    """
+    if numba_available is False or wl is None:
+        return
+    img = np.zeros((1, wl.shape[0]), dtype=dtype)
+    column_sum(img)
+    reduce_spectrum(img, wl, 0.0, None, wl2)
@@ -11,6 +11,7 @@ import traceback
 from twisted.internet import reactor, defer, error
 from twisted.internet.protocol import Protocol, ClientFactory, Factory
 from twisted.python.failure import Failure, reflect
+import PyTango as tango
 import PyTango.futures as tangof
 # import sys, os, inspect
 # currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
@@ -64,14 +65,22 @@ class TangoAttributeProtocol(Protocol):
         self._check_timeout_deferred = None
 
         self.logger = logging.getLogger("SpectrometerCameraController.Protocol_{0}_{1}".format(operation.upper(), name))
-        self.logger.setLevel(logging.WARNING)
+        # A protocol is built for every read, only set the level the first time the logger is used
+        if self.logger.level == logging.NOTSET:
+            self.logger.setLevel(logging.WARNING)
 
     def makeConnection(self, transport=None):
-        self.logger.debug("Protocol {0} make connection".format(self.name))
+        self.logger.debug("Protocol %s make connection", self.name)
         if self.operation == "read":
             self.d = deferred_from_future(self.factory.device.read_attribute(self.name, wait=False))
         elif self.operation == "write":
             self.d = deferred_from_future(self.factory.device.write_attribute(self.name, self.data, wait=False))
+        elif self.operation == "read_multi":
+            # data is a list of attribute names, read in a single request
+            self.d = deferred_from_future(self.factory.device.read_attributes(self.data, wait=False))
+        elif self.operation == "write_multi":
+            # data is a list of (attr_name, value) pairs, written in a single request
+            self.d = deferred_from_future(self.factory.device.write_attributes(self.data, wait=False))
         elif self.operation == "command":
             self.d = deferred_from_future(self.factory.device.command_inout(self.name, self.data, wait=False))
         elif self.operation == "check":
@@ -81,11 +90,11 @@ class TangoAttributeProtocol(Protocol):
 
     def dataReceived(self, data):
         self.result_data = data
-        self.logger.debug("Received data {0}".format(data))
+        self.logger.debug("Received data %s", data)
         return data
 
     def connectionLost(self, reason):
-        self.logger.debug("Connection lost, reason {0}".format(reason))
+        self.logger.debug("Connection lost, reason %s", reason)
         return reason
 
     # def check_attribute(self, attr_name, dev_name, target_value, period=0.3, timeout=1.0, tolerance=None, write=True):
@@ -234,19 +243,33 @@ class TangoAttributeFactory(Factory):
         self.d.addCallbacks(self.connection_success, self.connection_fail)
         return self.d
 
+    def resume(self):
+        """
+        Reuse the deviceproxy of a factory that was connected before, checking that the device still
+        answers with a ping. A factory that is not connected is started instead.
+
+        :return: Deferred that fires with the deviceproxy when the device answers.
+        """
+        if self.connected is not True:
+            return self.startFactory()
+        self.logger.info("Resuming TangoAttributeFactory")
+        d = deferred_from_future(self.device.ping(wait=False))
+        d.addCallbacks(lambda result: self.device, self.connection_fail)
+        return d
+
     def buildProtocol(self, operation, name, data=None, d=None, **kw):
         """
         Create a TangoAttributeProtocol that sends a Tango operation to the factory deviceproxy.
 
-        :param operation: Tango attribute operation, e.g. read, write, command
+        :param operation: Tango attribute operation, e.g. read, write, write_multi, command
         :param name: Name of Tango attribute
-        :param data: Data to send to Tango device, if any
+        :param data: Data to send to Tango device, if any. For write_multi a list of (name, value) pairs.
         :param d: Optional deferred to add the result of the Tango operation to
         :return: Deferred that fires when the Tango operation is completed.
         """
         if self.connected is True:
             self.logger.info("Connected, create protocol and makeConnection")
-            self.logger.debug("args: {0}, {1}, {2}, kw: {3}".format(operation, name, data, kw))
+            self.logger.debug("args: %s, %s, %s, kw: %s", operation, name, data, kw)
             proto = self.protocol(operation, name, data, **kw)
             proto.factory = self
             df = proto.makeConnection()
@@ -295,7 +318,7 @@ class TangoAttributeFactory(Factory):
         return err
 
     def data_received(self, result):
-        self.logger.debug("Data received: {0}".format(result))
+        self.logger.debug("Data received: %s", result)
         try:
             self.attribute_dict[result.name] = result
         except AttributeError:
@@ -303,6 +326,34 @@ class TangoAttributeFactory(Factory):
         self.logger.debug("Exiting data_received.")
         return result
 
+    def subscribe_event(self, name, callback):
+        """
+        Subscribe to change events for an attribute on the factory deviceproxy. The callback is called
+        with the DeviceAttribute from the event thread every time the attribute changes.
+        Events with errors are ignored.
+
+        :param name: Name of Tango attribute
+        :param callback: Callable taking the new DeviceAttribute as argument
+        :return: Deferred that fires with the event id when the subscription is done.
+        """
+        self.logger.info("Subscribing to change events for {0}".format(name))
+        if self.connected is not True:
+            return defer.fail(RuntimeError("Device {0} not connected".format(self.device_name)))
+
+        def event_cb(event):
+            if event.err is True:
+                self.logger.error("Event error for {0}: {1}".format(name, event.errors))
+                return
+            self.data_received(event.attr_value)
+            callback(event.attr_value)
+
+        return defer_to_thread(self.device.subscribe_event, name, tango.EventType.CHANGE_EVENT, event_cb)
+
+    def unsubscribe_event(self, event_id):
+        self.logger.info("Unsubscribing event {0}".format(event_id))
+        if self.device is not None:
+            self.device.unsubscribe_event(event_id)
+
     def get_attribute(self, name):
         if name in self.attribute_dict:
             self.logger.debug("Attribute {0} already read. Retrieve from dictionary.".format(name))
@@ -331,6 +382,57 @@ class LoopingCall(object):
         self.logger = logging.getLogger("TangoTwisted.LoopingCall")
         self.logger.setLevel(logging.WARNING)
 
+    @classmethod
+    def withCount(cls, countCallable):
+        """
+        An alternate constructor for LoopingCall that makes available the
+        number of calls which should have occurred since it was last invoked.
+        Ported from twisted.internet.task.LoopingCall.withCount.
+
+        The callable is not invoked when the timer fires before a new interval has
+        started (count 0), so an early firing timer can not double the call rate.
+
+        @param countCallable: A callable that will be invoked each time the
+            resulting LoopingCall is run, with an integer specifying the number
+            of calls that should have been invoked.
+        @return: A new LoopingCall
+        """
+
+        def counter():
+            now = time.time()
+
+            if self.interval == 0:
+                self._realLastTime = now
+                return countCallable(1)
+
+            lastTime = self._realLastTime
+            if lastTime is None:
+                lastTime = self.starttime
+                if self._runAtStart:
+                    lastTime -= self.interval
+            lastInterval = self._intervalOf(lastTime)
+            thisInterval = self._intervalOf(now)
+            count = thisInterval - lastInterval
+            if count > 0:
+                self._realLastTime = now
+                return countCallable(count)
+
+        self = cls(counter)
+
+        self._realLastTime = None
+
+        return self
+
+    def _intervalOf(self, t):
+        """
+        Determine the number of intervals passed as of the given point in time.
+        @param t: The specified time (from the start of the LoopingCall) to be measured in intervals
+        @return: The C{int} number of intervals which have passed as of the given point in time.
+        """
+        elapsedTime = t - self.starttime
+        intervalNum = int(elapsedTime / self.interval)
+        return intervalNum
+
     def start(self, interval, now=True):
         """
         Start running function every interval seconds.